@@ -1,65 +1,664 @@
 #!/usr/bin/env python
-import logging, nws, os, pnwsst, Queue, signal, subprocess, sys, thread, threading, time, re
+import array, BaseHTTPServer, heapq, json, logging, math, os, Queue, shlex, signal, socket, sqrunner, sqtaskfile, sqtelemetry, sqtransport, stat, subprocess, sys, threading, time, re, zlib
+from collections import deque
 LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
 
+# The driver runs a fixed set of threads, however many engines and
+# tasks there are: the dispatcher (runTasks, which also does DRAINs),
+# the completion collector (collectCompletions), the main thread
+# (signals and shutdown) and, with --pnwss, the workspace server or,
+# with --transport=native, the thread reading from the engines. Per
+# task work in each is constant, apart from logging. The target is
+# 10,000 concurrent engines driven from a single core; in practice
+# that will be bounded by the workspace server rather than the driver.
+
 # we assume that the helper script lives in the same directory as this script.
 WRAPPER = os.path.dirname(os.path.realpath(__file__))+os.path.sep+'SQDedWrapper.py'
 
-FetchDelay = float(os.environ.get('SQFetchDelay', '.2'))
+# wrappers report every task they are given (run, killed or never
+# started) by storing a status tuple in this variable.
+CompletionVar = 'task status'
+# and node samples (see sqtelemetry.py) in this one.
+TelemetryVar = 'telemetry'
+
+# launches are no longer throttled by default. SQLaunchDelay is now the
+# most the pacer will wait between launches when the workspace server
+# looks overloaded, i.e., when its round trip time rises above
+# SQLatencyTarget (or four times the best seen, if that is larger).
 LaunchDelay = float(os.environ.get('SQLaunchDelay', '.2'))
+LatencyTarget = float(os.environ.get('SQLatencyTarget', '.05'))
+PaceReportInterval = float(os.environ.get('SQPaceReportInterval', '60'))
+# the progress counters in the workspace are refreshed this often, or
+# after this many completions, whichever comes first.
+PublishInterval = float(os.environ.get('SQPublishInterval', '5'))
+PublishEvery = int(os.environ.get('SQPublishEvery', '100'))
+# completions are forced out to the journal after this many records or
+# this many seconds, whichever comes first.
+JournalSyncEvery = int(os.environ.get('SQJournalSyncEvery', '1000'))
+JournalSyncInterval = float(os.environ.get('SQJournalSyncInterval', '1'))
+# at most this many tasks read from a pipe, stdin or socket are held
+# waiting for engines; past that the producer is left blocked.
+StreamBuffer = int(os.environ.get('SQStreamBuffer', '10000'))
+# on shutdown, how long to wait for a reader stuck on a silent pipe to
+# hand over the line it may be reading, for REMAINING.
+StreamStopWait = float(os.environ.get('SQStreamStopWait', '5'))
+# with --packResources, up to this many tasks that don't fit anywhere
+# yet are set aside while later ones are placed around them.
+PackWindow = int(os.environ.get('SQPackWindow', '100'))
+# with --longestFirst, tasks between DRAINs are reordered in batches of
+# at most this many.
+SortWindow = int(os.environ.get('SQSortWindow', '100000'))
+# with --deadline, the run stops this many seconds before it, to leave
+# time to stop the engines and write REMAINING.
+DeadlineMargin = float(os.environ.get('SQDeadlineMargin', '60'))
+# with --speculate, once all tasks are launched, a task that has been
+# running SQSpeculateFactor times the median runtime (and at least
+# SQSpeculateMin seconds) gets a copy on an idle node. stragglers are
+# looked for every SQSpeculateInterval seconds, once SQSpeculateAfter
+# tasks have completed.
+SpeculateFactor = float(os.environ.get('SQSpeculateFactor', '3'))
+SpeculateMin = float(os.environ.get('SQSpeculateMin', '60'))
+SpeculateAfter = int(os.environ.get('SQSpeculateAfter', '10'))
+SpeculateInterval = float(os.environ.get('SQSpeculateInterval', '5'))
+# the driver's timings (see Metrics) are written to metrics.jsonl this
+# often, and once more at the end of the run (0: only then).
+MetricsInterval = float(os.environ.get('SQMetricsInterval', '60'))
+# the status server's recent rate (and so its projected finish) is over
+# the completions of this many seconds.
+RateWindow = float(os.environ.get('SQRateWindow', '300'))
 
-# XXX Is this purposely trying to generate an error if SQLaunchDelay
-# XXX is set to 0?  Seems odd, so I'm commenting it out. -sbw
-#if not LaunchDelay: LauncDelay
+# what a task without resource hints asks for: a core and no set memory.
+DefaultResources = (1, 0)
+ResHintRE = re.compile(r'#SQ_RES\b(.*)$')
 
 # this variant is for Slurm (or similar) use only.
 
 def gettasks():
+    if oArgs.local: return oArgs.local
+    if oArgs.nodeAgents: return int(os.getenv("SLURM_JOB_NUM_NODES"))
     return int(os.getenv("SLURM_NTASKS"))
 
 def launchcmd():
-    return ["srun"]
+    # SQ_LAUNCHER, if set, is used in place of srun, e.g.,
+    # sqLocalLaunch.py to run everything on this host.
+    launcher = shlex.split(os.getenv('SQ_LAUNCHER', 'srun'))
+    if oArgs.nodeAgents:
+        # one agent per node. its step needs the cpus of all the tasks
+        # it will run; on uneven allocations this is the smallest node's.
+        nodes = gettasks()
+        cpus = min(slurmCounts(os.getenv('SLURM_TASKS_PER_NODE'))) * int(os.getenv('SLURM_CPUS_PER_TASK', '1'))
+        return launcher + ["--nodes=%d"%nodes, "--ntasks=%d"%nodes, "--ntasks-per-node=1", "--cpus-per-task=%d"%cpus]
+    return launcher
+
+def slurmCounts(s):
+    # expand a Slurm per-node count list, e.g., '2(x3),1' -> [2, 2, 2, 1].
+    counts = []
+    for c in s.split(','):
+        m = re.match(r'(\d+)(?:\(x(\d+)\))?$', c)
+        counts += [int(m.group(1))] * int(m.group(2) or 1)
+    return counts
+
+def unquote(task):
+    task = task.strip()
+    if task[0] in '\'"': task = task[1:-1]
+    return task
+
+def taskCrc(task):
+    return zlib.crc32(unquote(task)) & 0xffffffff
+
+class Journal:
+    # an append-only record of the tasks a run has finished with, one
+    # line per task: its index and the crc32 of its command, in hex.
+    # records go out as completions come in and are fsync'ed in batches
+    # (see JournalSyncEvery and JournalSyncInterval). a crash may leave
+    # a torn last line, which is dropped when the journal is read back.
+    def __init__(self, fileName, resume=False):
+        self.fileName = fileName
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        # indexed by task index, so that a lookup is O(1) however many
+        # tasks there are.
+        self.done, self.crcs = bytearray(), array.array('I')
+        self.count = 0
+        if resume and os.path.exists(fileName): self.load()
+        self.f = open(fileName, resume and 'a' or 'w')
+        self.unsynced, self.lastSync = 0, time.time()
+
+    def load(self):
+        off = 0
+        for l in open(self.fileName):
+            if not l.endswith('\n'):
+                # cut it off, so that new records don't run on from it.
+                LogW('Dropping torn journal record: %s'%repr(l))
+                open(self.fileName, 'r+').truncate(off)
+                break
+            off += len(l)
+            try:
+                i, crc = l.split()
+                i, crc = int(i), int(crc, 16)
+            except ValueError:
+                LogW('Ignoring bad journal record: %s'%repr(l))
+                continue
+            if i >= len(self.done):
+                grow = max(i + 1, 2*len(self.done)) - len(self.done)
+                self.done.extend(bytearray(grow))
+                self.crcs.extend(array.array('I', [0])*grow)
+            if not self.done[i]: self.count += 1
+            self.done[i], self.crcs[i] = 1, crc
+
+    def isDone(self, i, task):
+        # a task whose command has changed since it was journaled is
+        # not considered done.
+        return i < len(self.done) and self.done[i] and self.crcs[i] == taskCrc(task)
+
+    def record(self, finished):
+        # finished is a list of (taskIndex, task).
+        if not finished: return
+        self.monSem.acquire()
+        self.f.write(''.join(['%d\t%08x\n'%(i, taskCrc(task)) for i, task in finished]))
+        self.unsynced += len(finished)
+        if self.unsynced >= JournalSyncEvery or time.time() - self.lastSync >= JournalSyncInterval:
+            self.syncLocked()
+        self.monSem.release()
+
+    def sync(self):
+        self.monSem.acquire()
+        if self.unsynced: self.syncLocked()
+        self.monSem.release()
+
+    def syncLocked(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced, self.lastSync = 0, time.time()
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+# the columns statusLine may put between the node and the task: resource
+# usage (all '-' if there was none) and the attempt.
+UsageColumns = re.compile(r'(?:-\t){6}|\d+\.\d{3}\t\d+\.\d{3}\t(?:-?\d+\t){4}')
+AttemptColumn = re.compile(r'[1-9]\d*\t')
+
+def statusTask(rest):
+    # the task, from what follows the node in a STATUS line. a task
+    # whose first word is a number can't be told from an attempt, so
+    # then the text with that number left in is returned too (or None).
+    m = UsageColumns.match(rest)
+    if m: rest = rest[m.end():]
+    m = AttemptColumn.match(rest)
+    if m and m.end() < len(rest): return rest[m.end():], rest
+    return rest, None
+
+class History:
+    # how long tasks took in earlier runs, from their STATUS files. a
+    # task is estimated by the mean of its command's runtimes, failing
+    # that by those of its program, and failing that by the mean of all.
+    def __init__(self, fileNames):
+        self.byTask, self.byProgram = {}, {}
+        self.total, self.count = 0., 0
+        for fileName in fileNames:
+            try:
+                f = open(fileName)
+            except IOError:
+                continue
+            n = 0
+            for l in f:
+                fields = l.rstrip('\n').split('\t', 7)
+                if len(fields) != 8: continue
+                try:
+                    startTime, stopTime = float(fields[2]), float(fields[3])
+                except ValueError:
+                    continue
+                # tasks that never ran, or were killed at shutdown.
+                if startTime < 0 or stopTime < startTime: continue
+                task, alt = statusTask(fields[7])
+                self.add(task, stopTime - startTime)
+                if alt: self.addTask(alt, stopTime - startTime)
+                n += 1
+            f.close()
+            LogI('Runtime history: %d task(s) from %s.'%(n, fileName))
+
+    def add(self, task, t):
+        for d, k in [(self.byTask, task), (self.byProgram, program(task))]:
+            e = d.setdefault(k, [0., 0])
+            e[0] += t
+            e[1] += 1
+        self.total += t
+        self.count += 1
+
+    def addTask(self, task, t):
+        # known under this text as well, without counting it twice.
+        e = self.byTask.setdefault(task, [0., 0])
+        e[0] += t
+        e[1] += 1
+
+    def estimate(self, task):
+        # (seconds, known).
+        e = self.byTask.get(task) or self.byProgram.get(program(task))
+        if e: return e[0]/e[1], True
+        return self.count and self.total/self.count or 0., False
+
+class Deadline:
+    # a task is only started if it is expected to finish before the run
+    # has to stop. runtimes seen in this run are added to the history.
+    def __init__(self, end, history):
+        self.end, self.cutoff = end, end - DeadlineMargin
+        self.history = history
+        self.shortest = None
+        self.skipped = 0
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+
+    def note(self, task, t):
+        self.monSem.acquire()
+        self.history.add(task, t)
+        if self.shortest == None or t < self.shortest: self.shortest = t
+        self.monSem.release()
+
+    def fits(self, task):
+        # (True or False, estimated runtime).
+        self.monSem.acquire()
+        est = self.history.estimate(unquote(task))[0]
+        self.monSem.release()
+        return time.time() + est <= self.cutoff, est
+
+    def over(self):
+        # not even the shortest task seen yet would finish in time.
+        return time.time() + (self.shortest or 0) > self.cutoff
+
+def program(task):
+    # the program a task runs, past any leading 'cd Dir;' or 'cd Dir &&'.
+    words = task.replace(';', ' ; ').split()
+    while len(words) > 3 and words[0] == 'cd' and words[2] in (';', '&&'): words = words[3:]
+    return words and words[0] or ''
+
+def memMB(v):
+    # e.g., 512M, 40G or 40960 (megabytes).
+    units = {'K': 1./1024, 'M': 1, 'G': 1024, 'T': 1024*1024}
+    v = v.upper().rstrip('B')
+    if v and v[-1] in units: return int(float(v[:-1])*units[v[-1]])
+    return int(v)
+
+def parseResources(words, default=DefaultResources):
+    # 'cores=N' and 'mem=Size' (see memMB); anything not given is as in default.
+    cores, mem = default
+    for w in words:
+        k, v = w.split('=', 1)
+        k = k.lower()
+        if k == 'cores':
+            cores = int(v)
+        elif k == 'mem':
+            mem = memMB(v)
+        else:
+            raise ValueError('unknown resource %s'%k)
+    return cores, mem
+
+def outputBase(spec):
+    # the name STATUS, REMAINING, etc. are based on.
+    if spec == '-': return 'stdin'
+    if spec.startswith('tcp:'): return 'tcp_' + spec[4:].replace(':', '_')
+    return spec
+
+def isStreamed(spec):
+    # stdin, a port, or a named pipe: read as it arrives (see TaskPipe).
+    if spec == '-' or spec.startswith('tcp:'): return True
+    try:
+        return stat.S_ISFIFO(os.stat(spec).st_mode)
+    except OSError:
+        return False
+
+class TaskPipe:
+    # tasks read as they arrive, from a named pipe, stdin ('-') or the
+    # first connection to a port the driver listens on ('tcp:[Host:]Port').
+    # a reader thread holds up to StreamBuffer of them for the
+    # dispatcher. beyond that it stops reading, so that once the pipe or
+    # socket buffer fills up, the producer blocks. bufCV is shared with
+    # the other streams (see TaskStreams), so one wait covers them all.
+    def __init__(self, spec, bufCV):
+        self.spec = spec
+        self.buf = deque()
+        self.bufCV = bufCV
+        self.eof, self.interrupted = False, False
+        self.sock = None
+        self.changes = 0 # bumped whenever there is something new to look at.
+        t = threading.Thread(None, self.reader)
+        t.setDaemon(True)
+        t.start()
+
+    def open(self):
+        # done in the reader, since this blocks until there is a producer.
+        if self.spec == '-': return sys.stdin
+        if self.spec.startswith('tcp:'):
+            host, port = ([''] + self.spec[4:].split(':'))[-2:]
+            lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            lsock.bind((host, int(port)))
+            lsock.listen(1)
+            LogI('Waiting for tasks on port %s.'%port)
+            sock, addr = lsock.accept()
+            lsock.close()
+            self.sock = sock
+            LogI('Reading tasks from %s.'%addr[0])
+            return sock.makefile('r')
+        return open(self.spec)
+
+    def reader(self):
+        c = 0
+        try:
+            f = self.open()
+            while 1:
+                l = f.readline()
+                if not l: break
+                l = l.strip()
+                if not l or (l[0] == '#' and not l.startswith('#SQ_OP')):
+                    if self.interrupted: break
+                    continue
+                self.bufCV.acquire()
+                while len(self.buf) >= StreamBuffer and not self.interrupted: self.bufCV.wait()
+                # on interruption this one still goes in, for REMAINING.
+                self.buf.append((c, l))
+                c += 1
+                self.changes += 1
+                self.bufCV.notifyAll()
+                stop = self.interrupted
+                self.bufCV.release()
+                if stop: break
+        except Exception, e:
+            LogE('Lost the task input %s: %s'%(self.spec, e))
+        LogI('Read %d task(s) from %s.'%(c, self.spec))
+        self.bufCV.acquire()
+        self.eof = True
+        self.changes += 1
+        self.bufCV.notifyAll()
+        self.bufCV.release()
+
+    def lines(self):
+        # (index, entry) as they arrive, with None whenever the buffer
+        # is empty. ends at the end of the input or on interruption.
+        while 1:
+            self.bufCV.acquire()
+            if self.interrupted or (self.eof and not self.buf):
+                self.bufCV.release()
+                return
+            entry = self.buf and self.buf.popleft() or None
+            self.bufCV.notifyAll()
+            self.bufCV.release()
+            yield entry
+
+    def interrupt(self):
+        self.bufCV.acquire()
+        self.interrupted = True
+        self.bufCV.notifyAll()
+        self.bufCV.release()
+
+    def unread(self):
+        # what is buffered but was never handed out. the reader stops at
+        # the next line it gets; anything after that stays with the
+        # producer. a line it is in the middle of reading is waited for,
+        # but only for so long: a socket is shut down, so that the read
+        # ends at once, while a pipe may have no writer saying anything.
+        self.interrupt()
+        if self.sock:
+            try: self.sock.shutdown(socket.SHUT_RD)
+            except socket.error: pass
+        self.bufCV.acquire()
+        end = time.time() + StreamStopWait
+        while not self.eof and time.time() < end: self.bufCV.wait(max(end - time.time(), 0))
+        if not self.eof: LogW('Gave up waiting for %s: a task read from it after this is not in REMAINING.'%self.spec)
+        entries = list(self.buf)
+        self.buf.clear()
+        self.bufCV.release()
+        return entries
+
+class Group:
+    # tasks between '#SQ_OP GROUP Name' and the next GROUP line. it is
+    # closed by the first '#SQ_OP AFTER' naming it; a later GROUP line
+    # with the same name starts a new group.
+    def __init__(self, name):
+        self.name = name
+        self.pending = 0 # members not yet finished, held ones included.
+        self.closed = False
+        self.waiters = []
+
+class Hold:
+    # the tasks between an '#SQ_OP AFTER Name ...' line and the next
+    # AFTER line, held until all the named groups have finished.
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.deps = 0 # named groups not yet finished.
+        self.tasks = []
 
 class TaskStream:
-    def __init__(self, f):
+    # one task file (or pipe), with its own STATUS, ROGUES, REMAINING
+    # and JOURNAL. indices here are the stream's own.
+    def __init__(self, spec, index, priority, resume, bufCV, history=None):
         self.inflight = {}
         self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
-        self.taskFileName = f
+        self.spec, self.index, self.priority = spec, index, priority
+        self.taskFileName = outputBase(spec)
         self.taskgen = None
         self.tc = 0
-        self.tf = open(f)
-        
+        if isStreamed(spec):
+            self.tasks, self.pipe = TaskPipe(spec, bufCV), True
+            LogI('Streaming tasks from %s, buffering up to %d.'%(spec, StreamBuffer))
+        else:
+            self.tasks, self.pipe = sqtaskfile.TaskFile(spec), False
+        self.journal = Journal(self.taskFileName+'.JOURNAL', resume)
+        # when resuming, tasks the journal says are done are skipped.
+        self.resume = resume
+        if resume: LogI('Resuming: %d task(s) already done according to %s.'%(self.journal.count, self.journal.fileName))
+        self.skipped = 0
+        # what this run has to do, if known: the tasks in the file less
+        # those an earlier run finished. and what it has done so far.
+        if self.pipe:
+            self.total = None
+        else:
+            self.total = max(self.tasks.ntasks - self.journal.count, 0)
+        self.done = 0
+        # a resumed run adds to the earlier run's records.
+        mode = resume and 'a' or 'w'
+        self.taskStatus = open(self.taskFileName+'.STATUS', mode, 0)
+        self.taskRogues = open(self.taskFileName+'.ROGUES', mode, 0)
+        # the rest are looked after by TaskStreams.
+        self.active = 0 # tasks assigned to engines and not yet released.
+        self.barrier = None # index of the DRAIN holding this stream back.
+        self.lastDrain = None # stream index of the last DRAIN handed out.
+        self.drains = 0 # DRAINs handed out, i.e., the stream's current segment.
+        self.finished = False
+        # dependencies (see Group and Hold).
+        self.groups = {}
+        self.group, self.after = None, None
+        self.member = {} # task -> its group.
+        self.context = {} # task -> (group name, names it is after), if either.
+        self.held = 0
+        self.ready = deque() # held tasks that may now go.
+        # resource hints (see --packResources), kept for tasks that have any.
+        self.res, self.resSpec = DefaultResources, None
+        self.resources = {}
+        self.packing, self.warnedRes = False, False
+        # with a runtime history, tasks read ahead and reordered longest
+        # first, up to the next DRAIN (see --longestFirst).
+        self.history = history
+        if history and self.pipe:
+            LogW('%s: tasks are run in the order they arrive; ignoring longestFirst.'%spec)
+            self.history = None
+        self.sorted = deque()
+
     def nexttask(self):
-        for l in self.tf:
-            l = l.strip()
-            if l and (l[0] != '#' or l.startswith('#SQ_OP')):
-                c = self.tc
-                self.tc = c + 1
-                yield (c, l)
-        self.tf.close()
+        for entry in self.tasks.lines():
+            if entry == None:
+                yield entry
+                continue
+            c, l = entry
+            self.tc = c + 1
+            if self.resume and self.journal.isDone(c, l):
+                self.skipped += 1
+                continue
+            yield (c, l)
 
     def __iter__(self):
         if not self.taskgen:
             self.taskgen = self.nexttask()
         return self.taskgen
 
+    # the following are called with TaskStreams.cv held.
+
+    def read(self):
+        # the next entry to hand out, or None if there is none for now.
+        if not self.history: return self.readEntry()
+        if not self.sorted: self.readSegment()
+        return self.sorted.popleft()
+
+    def readSegment(self):
+        # the tasks up to the next operation, longest first. ties, and
+        # tasks no earlier run has seen, keep their order in the file.
+        batch, op = [], []
+        while len(batch) < SortWindow:
+            try:
+                entry = self.readEntry()
+            except StopIteration:
+                if batch: break
+                raise
+            if entry[1].startswith('#SQ_OP'):
+                op = [entry]
+                break
+            batch.append(entry)
+        # the history has tasks as STATUS records them: unquoted.
+        est = dict([(x, self.history.estimate(unquote(l))) for x, l in batch])
+        batch.sort(key=lambda e: -est[e[0]][0])
+        if batch: LogI('%s: ordered %d task(s) longest first (%d with no history, estimated %.1fs in all).'%(self.spec, len(batch), len([x for x in est if not est[x][1]]), sum([e[0] for e in est.values()])))
+        self.sorted.extend(batch + op)
+
+    def readEntry(self):
+        # tasks that have to wait for groups are put aside meanwhile.
+        while 1:
+            entry = iter(self).next()
+            if entry == None: return None
+            x, l = entry
+            if l.startswith('#SQ_OP'):
+                op = l.split()
+                if len(op) >= 2 and op[1].upper() == 'GROUP':
+                    self.setGroup(op[2:3])
+                    continue
+                if len(op) >= 2 and op[1].upper() == 'AFTER':
+                    self.setAfter(op[2:])
+                    continue
+                if len(op) >= 2 and op[1].upper() == 'RESOURCES':
+                    try:
+                        self.res, self.resSpec = parseResources(op[2:]), ' '.join(op[2:]) or None
+                    except ValueError, e:
+                        LogW('%s: ignoring bad resource hints (%s): %s'%(self.spec, e, l))
+                    continue
+                return entry
+            res = self.res
+            m = ResHintRE.search(l)
+            if m:
+                try:
+                    res = parseResources(m.group(1).split(), self.res)
+                except ValueError, e:
+                    LogW('%s: ignoring bad resource hints (%s): %s'%(self.spec, e, l))
+            if res != DefaultResources:
+                if self.packing:
+                    self.resources[x] = res
+                elif not self.warnedRes:
+                    LogW('%s: resource hints are ignored without --packResources.'%self.spec)
+                    self.warnedRes = True
+            if self.group or self.after or self.resSpec:
+                self.context[x] = (self.group and self.group.name, self.after and self.after.names, self.resSpec)
+            if self.group:
+                self.group.pending += 1
+                self.member[x] = self.group
+            if self.after:
+                self.after.tasks.append(entry)
+                self.held += 1
+                continue
+            return entry
+
+    def setGroup(self, names):
+        if not names:
+            self.group = None
+            return
+        g = self.groups.get(names[0])
+        if not g or g.closed:
+            g = self.groups[names[0]] = Group(names[0])
+        self.group = g
+
+    def setAfter(self, names):
+        h = Hold(names)
+        for name in names:
+            g = self.groups.get(name)
+            if not g:
+                LogW('%s: AFTER names unknown group %s; ignoring it.'%(self.spec, name))
+                continue
+            g.closed = True
+            if g is self.group: self.group = None
+            if g.pending:
+                h.deps += 1
+                g.waiters.append(h)
+        self.after = h.deps and h or None
+
+    def finish(self, x):
+        # task x has been released. returns True if that let held tasks go.
+        g = self.member.pop(x, None)
+        if not g: return False
+        g.pending -= 1
+        if g.pending or not g.closed: return False
+        changed = False
+        for h in g.waiters:
+            h.deps -= 1
+            if not h.deps:
+                self.ready.extend(h.tasks)
+                self.held -= len(h.tasks)
+                h.tasks = []
+                if self.after is h: self.after = None
+                changed = True
+        g.waiters = []
+        return changed
+
+    def idle(self):
+        # nothing before a DRAIN is still to run.
+        return not (self.active or self.held or self.ready)
+
     def setInflight(self, i, info):
         self.monSem.acquire()
         self.inflight[i] = info
         self.monSem.release()
 
+    def getInflight(self, i):
+        # (engine, host, time sent, task), or None.
+        self.monSem.acquire()
+        info = self.inflight.get(i)
+        self.monSem.release()
+        return info
+
+    def getTask(self, i):
+        info = self.getInflight(i)
+        return info and info[-1]
+
     def setDone(self, i):
         self.monSem.acquire()
         self.inflight.pop(i)
+        self.context.pop(i, None)
         self.monSem.release()
 
     def dumpInflight(self):
-        LogI('Inflight:')
+        LogI('Inflight (%s):'%self.spec)
         self.monSem.acquire()
         for x in sorted(self.inflight.keys()):
             LogI('\t%d: %s'%(x, repr(self.inflight[x])))
         self.monSem.release()
+
+    def close(self):
+        self.taskRogues.close()
+        self.taskStatus.close()
+        self.journal.close()
         
+    def writeContext(self, f, old, new):
+        # the GROUP, AFTER and RESOURCES lines needed to go from context old to new.
+        if new[0] != old[0]: f.write(' '.join(['#SQ_OP', 'GROUP'] + (new[0] and [new[0]] or []))+'\n')
+        if new[1] != old[1]: f.write(' '.join(['#SQ_OP', 'AFTER'] + list(new[1] or ()))+'\n')
+        if new[2] != old[2]: f.write(' '.join(['#SQ_OP', 'RESOURCES'] + (new[2] and [new[2]] or []))+'\n')
+        return new
+
     def dumpRemaining(self):
         # TODO: make sure this is done under a lock!
         # doing this even when all tasks are "done" avoids stale REMAINING files.
@@ -67,15 +666,781 @@ class TaskStream:
         LogI('Remaining tasks dumped to %s.'%dumpfile)
 
         f = open(dumpfile, 'w')
-        for x in sorted(self.inflight.keys()):
-            f.write('%s\n'% self.inflight.pop(x)[-1])
-
-        for x, t in self.taskgen:
+        # held tasks (never launched) go in along with the ones in flight,
+        # in their original order and with the GROUP and AFTER lines that
+        # applied to them.
+        left = [(x, self.inflight.pop(x)[-1]) for x in self.inflight.keys()] + list(self.ready) + list(self.sorted)
+        for g in self.groups.values():
+            for h in g.waiters: left += h.tasks
+        # the last DRAIN passed comes back in if anything before it is left.
+        if self.lastDrain != None and [x for x, t in left if x < self.lastDrain]: left.append((self.lastDrain, '#SQ_OP DRAIN'))
+        ctx = (None, None, None)
+        for x, t in sorted(dict(left).items()):
+            if not t.startswith('#SQ_OP'): ctx = self.writeContext(f, ctx, self.context.get(x, (None, None, None)))
             f.write('%s\n'%t)
+        self.writeContext(f, ctx, (self.group and self.group.name, self.after and self.after.names, self.resSpec))
+
+        if self.pipe:
+            rest = self.tasks.unread()
+        elif self.resume:
+            rest = iter(self)
+        else:
+            self.tasks.copyTail(self.tc, f)
+            self.tasks.close()
+            rest = []
+        for x, t in rest:
+            # some of what is left may have been done in an earlier run.
+            if not (self.resume and self.journal.isDone(x, t)): f.write('%s\n'%t)
         f.close()
-        
+
+class TaskStreams:
+    # all of a run's task streams. tasks are numbered across them: task x
+    # of stream s is task x*n + s of the run, so with a single stream the
+    # numbers are the stream's own. the dispatcher takes the next task
+    # from the highest priority stream that has one ready; streams of the
+    # same priority take turns. a stream is not ready while its input has
+    # run dry, or while it is held at a DRAIN until all of its earlier
+    # tasks have finished. other streams carry on meanwhile, as do later
+    # tasks of a stream whose held tasks wait for groups (see Hold).
+    def __init__(self, specs, resume, packing=False, history=None):
+        self.cv = threading.Condition()
+        self.changes, self.seen = 0, -1
+        # when packing, releases can make room for tasks set aside, so
+        # they count as changes too.
+        self.packing = packing
+        self.interrupted = False
+        self.n = len(specs)
+        self.streams = [TaskStream(spec, s, priority, resume, self.cv, history) for s, (spec, priority) in enumerate(specs)]
+        for ts in self.streams: ts.packing = packing
+        self.tiers = [[ts for ts in self.streams if ts.priority == p] for p in sorted(set([ts.priority for ts in self.streams]), reverse=True)]
+
+    def locate(self, i):
+        # the stream task i of the run belongs to and its index there.
+        return self.streams[i % self.n], i / self.n
+
+    def name(self, i):
+        # task i as the user would know it.
+        if self.n == 1: return '%d'%i
+        ts, x = self.locate(i)
+        return '%s %d'%(ts.spec, x)
+
+    def version(self):
+        # must be called with cv held.
+        return self.changes + sum([ts.tasks.changes for ts in self.streams if ts.pipe])
+
+    def next(self):
+        # (stream, run index, entry) for the next task to hand out, or None
+        # if no stream has one ready. StopIteration once all are finished.
+        self.cv.acquire()
+        try:
+            self.seen = self.version()
+            for tier in self.tiers:
+                for k in xrange(len(tier)):
+                    ts = tier[k]
+                    if self.interrupted: continue
+                    if ts.ready:
+                        # these came before anything a DRAIN holds back.
+                        entry = ts.ready.popleft()
+                    elif ts.finished or ts.barrier != None:
+                        continue
+                    else:
+                        try:
+                            entry = ts.read()
+                        except StopIteration:
+                            ts.finished = True
+                            continue
+                        if entry == None: continue
+                    # the rest of its tier go first next time.
+                    tier.append(tier.pop(k))
+                    return ts, entry[0]*self.n + ts.index, entry[1]
+            if self.interrupted or not [ts for ts in self.streams if not ts.finished or ts.held or ts.ready]: raise StopIteration
+            return None
+        finally:
+            self.cv.release()
+
+    def mark(self):
+        # note the state of things, for a wait() after trying something other than next().
+        self.cv.acquire()
+        self.seen = self.version()
+        self.cv.release()
+
+    def wait(self, timeout=None):
+        # after next() came up empty, wait for something to change, or
+        # for timeout to pass.
+        self.cv.acquire()
+        if timeout != None: timeout += time.time()
+        while self.version() == self.seen and not self.interrupted:
+            if timeout == None:
+                self.cv.wait()
+            elif timeout > time.time():
+                self.cv.wait(timeout - time.time())
+            else:
+                break
+        self.cv.release()
+
+    def poke(self):
+        # wake the dispatcher, for something outside the streams.
+        self.cv.acquire()
+        self.changes += 1
+        self.cv.notifyAll()
+        self.cv.release()
+
+    def blockedBy(self):
+        # what the dispatcher is waiting for, when next() comes up empty.
+        self.cv.acquire()
+        if [ts for ts in self.streams if ts.held]:
+            cause = 'dependencies'
+        elif [ts for ts in self.streams if ts.barrier != None]:
+            cause = 'DRAINs'
+        else:
+            cause = 'input'
+        self.cv.release()
+        return cause
+
+    def drain(self, ts, i):
+        self.cv.acquire()
+        ts.lastDrain = self.locate(i)[1]
+        ts.drains += 1
+        if not ts.idle():
+            ts.barrier = i
+        else:
+            LogI('Done drain (%s).'%self.name(i))
+        self.cv.release()
+
+    def assigned(self, indices):
+        self.cv.acquire()
+        for i in indices: self.streams[i % self.n].active += 1
+        self.cv.release()
+
+    def release(self, i, completed):
+        ts, x = self.locate(i)
+        if completed: ts.setDone(x)
+        self.cv.acquire()
+        ts.active -= 1
+        ts.done += 1
+        if ts.finish(x) or self.packing:
+            self.changes += 1
+            self.cv.notifyAll()
+        if ts.barrier != None and ts.idle():
+            LogI('Done drain (%s).'%self.name(ts.barrier))
+            ts.barrier = None
+            self.changes += 1
+            self.cv.notifyAll()
+        self.cv.release()
+
+    def setInflight(self, i, info):
+        ts, x = self.locate(i)
+        ts.setInflight(x, info)
+
+    def getTask(self, i):
+        ts, x = self.locate(i)
+        return ts.getTask(x)
+
+    def resources(self, i):
+        # (cores, memory in MB) that task i asked for.
+        ts, x = self.locate(i)
+        return ts.resources.pop(x, DefaultResources)
+
+    def interrupt(self):
+        # stop waiting for more input.
+        self.cv.acquire()
+        self.interrupted = True
+        for ts in self.streams:
+            if ts.pipe: ts.tasks.interrupt()
+        self.cv.notifyAll()
+        self.cv.release()
+
+    def status(self):
+        # for the status server.
+        self.cv.acquire()
+        snap = [{'file': ts.spec, 'priority': ts.priority, 'tasks': ts.total, 'done': ts.done, 'skipped': ts.skipped,
+                 'active': ts.active, 'held': ts.held, 'segment': ts.drains, 'finished': ts.finished,
+                 'drainingAt': ts.barrier != None and self.name(ts.barrier) or None} for ts in self.streams]
+        self.cv.release()
+        return snap
+
+    def sync(self):
+        for ts in self.streams: ts.journal.sync()
+
+    def syncer(self):
+        # bounds how long journal records that came in during a lull go
+        # without an fsync.
+        while JournalSyncInterval > 0:
+            time.sleep(JournalSyncInterval)
+            self.sync()
+
+    def dumpInflight(self):
+        for ts in self.streams: ts.dumpInflight()
+
+    def close(self):
+        for ts in self.streams: ts.close()
+
+    def dumpRemaining(self):
+        for ts in self.streams: ts.dumpRemaining()
+
+class Histogram:
+    # bucket k counts the values (in seconds) of at most 2**k microseconds.
+    def __init__(self):
+        self.count, self.sum, self.max = 0, 0., 0.
+        self.buckets = {}
+
+    def add(self, v):
+        self.count += 1
+        self.sum += v
+        if v > self.max: self.max = v
+        k = max(math.frexp(v*1e6)[1], 0)
+        self.buckets[k] = self.buckets.get(k, 0) + 1
+
+    def quantile(self, q):
+        # the upper bound of the bucket holding the q'th quantile.
+        n, seen = q*self.count, 0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen >= n: return min(2.**k/1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(.5), 'p90': self.quantile(.9), 'p99': self.quantile(.99),
+                'buckets': dict([('%g'%(2.**k/1e6), n) for k, n in self.buckets.items()])}
+
+class Metrics:
+    # timings of the driver's hot paths, as histograms counted from the
+    # start of the run. each write adds a line to the metrics file: a
+    # JSON object with the time, the seconds since the start, and a
+    # snapshot of each histogram.
+    def __init__(self):
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        self.histograms = {}
+        self.startTime = time.time()
+        self.f = None
+
+    def observe(self, name, v):
+        self.monSem.acquire()
+        h = self.histograms.get(name)
+        if h == None: h = self.histograms[name] = Histogram()
+        h.add(v)
+        self.monSem.release()
+
+    def snapshot(self):
+        now = time.time()
+        self.monSem.acquire()
+        snap = dict([(name, h.snapshot()) for name, h in self.histograms.items()])
+        self.monSem.release()
+        return {'time': now, 'elapsed': now - self.startTime, 'metrics': snap}
+
+    def write(self):
+        if not self.f: return
+        self.f.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+        self.f.flush()
+
+    def writer(self):
+        while MetricsInterval > 0:
+            time.sleep(MetricsInterval)
+            self.write()
+
+class TimedLock:
+    # a Lock that notes (as metric name) how long an acquire had to wait,
+    # when it had to wait at all.
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=1):
+        if self.lock.acquire(0): return True
+        if not blocking: return False
+        t0 = time.time()
+        self.lock.acquire()
+        metrics.observe(self.name, time.time() - t0)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+class LaunchPacer:
+    def __init__(self, maxDelay, target):
+        self.maxDelay, self.target = maxDelay, target
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        self.baseline = None # best round trip seen.
+        self.latency = None  # moving average of recent round trips.
+        self.delay = 0.
+        self.launches, self.slept, self.backoffs = 0, 0., 0
+        self.startTime = self.lastReport = time.time()
+
+    def noteLatency(self, latency):
+        metrics.observe('send', latency)
+        self.monSem.acquire()
+        if self.baseline == None or latency < self.baseline: self.baseline = latency
+        if self.latency == None:
+            self.latency = latency
+        else:
+            self.latency += .2*(latency - self.latency)
+        self.monSem.release()
+
+    def pace(self):
+        # called after each launch. no delay unless the workspace server
+        # is lagging; then back off exponentially (up to maxDelay) and
+        # ease off again as it recovers.
+        self.monSem.acquire()
+        self.launches += 1
+        if self.latency != None and self.latency > max(self.target, 4*self.baseline):
+            if not self.delay: self.backoffs += 1
+            self.delay = min(self.maxDelay, max(.001, 2*self.delay))
+        elif self.delay > .001:
+            self.delay /= 2
+        else:
+            self.delay = 0.
+        delay = self.delay
+        self.slept += delay
+        report = time.time() - self.lastReport >= PaceReportInterval
+        if report: self.lastReport = time.time()
+        self.monSem.release()
+
+        if report:
+            self.report()
+            transport.report()
+        if delay: time.sleep(delay)
+
+    def report(self, final=False):
+        self.monSem.acquire()
+        elapsed = max(time.time() - self.startTime, 1e-6)
+        LogI('Launch pacing%s: %d launches in %.1fs (%.1f/s), current delay %.3fs, total delay %.1fs, %d backoff(s), workspace latency %.1fms (best %.1fms, target %.1fms).'%(
+            final and ' (final)' or '', self.launches, elapsed, self.launches/elapsed, self.delay, self.slept, self.backoffs,
+            1000*(self.latency or 0), 1000*(self.baseline or 0), 1000*self.target))
+        self.monSem.release()
+
+class Progress:
+    # the driver's own counts of launched and finished tasks. watchers
+    # (e.g., through the pnwss web port) see them as the workspace
+    # variables Launched, Done, Succeeded and Failed, which are only
+    # republished from here: within PublishInterval seconds of a change
+    # (plus the time to get a pool connection), or sooner once
+    # PublishEvery more tasks have finished. 'Progress Time' holds the
+    # driver's clock at the last publish.
+    names = ['Launched', 'Done', 'Succeeded', 'Failed']
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.names, 0)
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        self.publishCV = threading.Condition(self.monSem)
+        self.changed = False
+        self.finishedSince = 0
+        self.publishes = 0
+        # (time, Done) at least a second apart, over the last RateWindow
+        # seconds, for the status server.
+        self.startTime = time.time()
+        self.marks = deque()
+
+    def add(self, name, n):
+        self.monSem.acquire()
+        self.counts[name] += n
+        self.changed = True
+        if name == 'Done':
+            self.finishedSince += n
+            if self.finishedSince >= PublishEvery: self.publishCV.notify()
+            now = time.time()
+            if not self.marks or now - self.marks[-1][0] >= 1: self.marks.append((now, self.counts['Done']))
+            self.prune(now)
+        self.monSem.release()
+
+    def prune(self, now):
+        # must be called with monSem held.
+        while self.marks and now - self.marks[0][0] > RateWindow: self.marks.popleft()
+
+    def rates(self):
+        # the counts, and tasks done per second since the start and over
+        # the last RateWindow seconds. unlike snapshot, this doesn't
+        # count as a publish.
+        self.monSem.acquire()
+        now = time.time()
+        self.prune(now)
+        counts = dict(self.counts)
+        done = counts['Done']
+        overall = done/max(now - self.startTime, 1e-6)
+        if not self.marks:
+            recent = 0.
+        elif now - self.marks[0][0] < 1:
+            recent = overall
+        else:
+            recent = (done - self.marks[0][1])/(now - self.marks[0][0])
+        self.monSem.release()
+        return counts, overall, recent
+
+    def snapshot(self):
+        self.monSem.acquire()
+        snap = dict(self.counts)
+        self.changed = False
+        self.finishedSince = 0
+        self.publishes += 1
+        self.monSem.release()
+        return snap
+
+    def publisher(self):
+        while 1:
+            self.publishCV.acquire()
+            self.publishCV.wait(PublishInterval)
+            changed = self.changed
+            self.publishCV.release()
+            if changed: transport.publish(self.snapshot())
+
+def publishProgress(conn, snap):
+    for name in Progress.names:
+        conn.store(name, str(snap[name]))
+    conn.store('Progress Time', time.time())
+
+class WsPool:
+    # a fixed set of connections to the run's workspace, each owned by a
+    # worker thread, so that independent workspace operations can be in
+    # progress at once without interleaving on one protocol stream.
+    # jobs are called as fn(conn, *args). the wait figures are the time
+    # jobs sat queued before a connection was free to run them.
+    def __init__(self, key, host, port, size):
+        self.size = size
+        self.jobs = Queue.Queue(0)
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        self.idleCV = threading.Condition(self.monSem)
+        self.pending = 0
+        self.jobCount, self.waited, self.maxWait = 0, 0., 0.
+        for x in xrange(size):
+            conn = nws.client.NetWorkSpace(key, serverHost=host, serverPort=port)
+            t = threading.Thread(None, self.work, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def work(self, conn):
+        while 1:
+            posted, fn, args, reply = self.jobs.get(True)
+            wait = time.time() - posted
+            metrics.observe('poolWait', wait)
+            self.monSem.acquire()
+            self.jobCount += 1
+            self.waited += wait
+            if wait > self.maxWait: self.maxWait = wait
+            self.monSem.release()
+
+            result = None, None
+            try:
+                result = fn(conn, *args), None
+            except Exception, e:
+                LogI('Encountered exception "%s" in workspace operation %s.'%(e, fn.__name__))
+                result = None, e
+            if reply: reply.put(result)
+
+            self.monSem.acquire()
+            self.pending -= 1
+            if not self.pending: self.idleCV.notifyAll()
+            self.monSem.release()
+
+    def post(self, fn, *args):
+        self.submit(fn, args, None)
+
+    def call(self, fn, *args):
+        reply = Queue.Queue(1)
+        self.submit(fn, args, reply)
+        result, e = reply.get(True)
+        if e: raise e
+        return result
+
+    def submit(self, fn, args, reply):
+        self.monSem.acquire()
+        self.pending += 1
+        self.monSem.release()
+        self.jobs.put((time.time(), fn, args, reply))
+
+    def flush(self):
+        # wait until everything posted so far has been done.
+        self.idleCV.acquire()
+        while self.pending: self.idleCV.wait()
+        self.idleCV.release()
+
+    def report(self):
+        self.monSem.acquire()
+        LogI('Workspace pool: %d connections, %d operations, %d queued, pool wait %.1fs total (mean %.2fms, max %.1fms).'%(
+            self.size, self.jobCount, self.pending, self.waited, 1000*self.waited/max(self.jobCount, 1), 1000*self.maxWait))
+        self.monSem.release()
+
+class NwsTransport:
+    # engines talk to the driver through a NetWorkSpace server. tasks,
+    # replies and poison go out through the pool; completions come in
+    # on a connection of the collector's own.
+    def __init__(self, key, host, port, poolSize):
+        self.key, self.host, self.port = key, host, port
+        self.lost = () # gone engines aren't noticed here (see NativeServer).
+        self.ws = nws.client.NetWorkSpace(key, serverHost=host, serverPort=port)
+        # the counters are overwritten rather than fetched and stored.
+        for name in Progress.names: self.ws.declare(name, 'single')
+        # ws itself is only used during startup; after that, workspace
+        # operations go through the pool or the collector's connection.
+        self.pool = WsPool(key, host, port, poolSize)
+        self.cws = nws.client.NetWorkSpace(key, serverHost=host, serverPort=port)
+        self.tws = None
+
+    def wrapperArgs(self):
+        return [self.key, self.host, str(self.port)]
+
+    def register(self):
+        # node agents also say how many slots they have.
+        return (self.ws.fetch('engine info') + (0,))[:3]
+
+    def reply(self, en, reply):
+        self.ws.store('engine %s status'%en, reply)
+
+    def sendTasks(self, en, tasks):
+        self.pool.post(storeTasks, en, tasks)
+
+    def kill(self, en, i):
+        self.pool.post(storeKill, en, i)
+
+    def sendBye(self, engines):
+        # chunks already handed to the pool go out ahead of the poison.
+        self.pool.flush()
+        engines = sorted(engines)
+        for x in xrange(self.pool.size):
+            self.pool.post(sendPoison, engines[x::self.pool.size])
+        self.pool.flush()
+
+    def nextCompletions(self):
+        # block for one status, then take whatever else has queued up.
+        noStatus = (-1, -1, -1., -1., True, -1, 'no where', -1)
+        batch = [self.cws.fetch(CompletionVar)]
+        while 1:
+            st = self.cws.fetchTry(CompletionVar, noStatus)
+            if st is noStatus: break
+            batch.append(st)
+        return batch
+
+    def nextTelemetry(self):
+        # block for the next batch of samples: (host, samples). only the
+        # telemetry thread calls this, on a connection of its own.
+        if not self.tws: self.tws = nws.client.NetWorkSpace(self.key, serverHost=self.host, serverPort=self.port)
+        return self.tws.fetch(TelemetryVar)
+
+    def publish(self, snap, wait=False):
+        if wait:
+            self.pool.call(publishProgress, snap)
+        else:
+            self.pool.post(publishProgress, snap)
+
+    def report(self):
+        self.pool.report()
+
+    def stop(self):
+        if oArgs.pnwss: pnwss.stop()
+
+class NativeTransport(sqtransport.NativeServer):
+    # engines connect straight to the driver (see sqtransport.py). with
+    # no workspace, there is nowhere to publish progress to.
+    def wrapperArgs(self):
+        return [self.key, self.host, str(self.port)]
+
+    def sendTasks(self, en, tasks):
+        t0 = time.time()
+        try:
+            sqtransport.NativeServer.sendTasks(self, en, tasks)
+        except Exception, e:
+            # count them as never started, so they end up in REMAINING.
+            LogW('Could not send tasks to engine %s: %s'%(en, e))
+            for i, task in tasks: self.completions.put((i, None, -1., -1., 0, 0, 'no where', en))
+            return
+        pacer.noteLatency(time.time() - t0)
+        progress.add('Launched', len(tasks))
+
+    def sendBye(self, engines):
+        for en in engines: self.bye(en)
+
+    def publish(self, snap, wait=False):
+        pass
+
+    def report(self):
+        pass
+
+class LocalEngine(threading.Thread):
+    # one of the driver's own slots (--local). it runs the tasks sent to
+    # it one after another, as a wrapper's runner would, with the same
+    # output files, and reports them the same way.
+    def __init__(self, transport, en, outbase):
+        threading.Thread.__init__(self, name='LocalEngine %s'%en)
+        self.setDaemon(True)
+        self.transport, self.en, self.outbase = transport, en, outbase
+        self.cv = threading.Condition()
+        self.pending = deque()
+        self.current, self.pid = None, None
+        self.stopping, self.whacked = False, False
+
+    def run(self):
+        while 1:
+            self.cv.acquire()
+            while not self.pending and not self.stopping: self.cv.wait()
+            if self.stopping:
+                self.cv.release()
+                break
+            i, task = self.current = self.pending.popleft()
+            try:
+                p, startTime = sqrunner.startTask(i, task, self.outbase)
+            except (IOError, OSError), e:
+                LogE('Task %d: could not be started: %s'%(i, e))
+                self.current = None
+                self.cv.release()
+                self.transport.done(i, None, -1.0, -1.0, 0, 0, self.en)
+                continue
+            self.pid = p.pid
+            self.cv.release()
+
+            status, usage = sqrunner.waitTask(p)
+            self.cv.acquire()
+            self.current, self.pid = None, None
+            whacked, self.whacked = self.whacked, False
+            self.cv.release()
+            # if the task had to be whacked at the end, the dummy status has gone already.
+            if not whacked: self.transport.done(i, status, startTime, time.time(), 0, p.pid, self.en, usage)
+
+    def add(self, tasks):
+        self.cv.acquire()
+        self.pending.extend(tasks)
+        self.cv.notify()
+        self.cv.release()
+
+    def kill(self, j):
+        # the driver has no more use for task j: drop it if it hasn't
+        # started, or kill it if it has.
+        self.cv.acquire()
+        dropped = [t for t in self.pending if t[0] == j]
+        for t in dropped: self.pending.remove(t)
+        pid = self.current and self.current[0] == j and self.pid
+        self.cv.release()
+        for t in dropped: self.transport.done(j, None, -1.0, -1.0, 0, 0, self.en)
+        if pid:
+            LogI('Task %d: killing pid %d, as asked.'%(j, pid))
+            killGroup(pid, 9)
+
+    def stop(self):
+        # no more tasks: those not started are reported as such. returns
+        # the pid of the task still running, if any.
+        self.cv.acquire()
+        self.stopping = True
+        unstarted = list(self.pending)
+        self.pending.clear()
+        pid = self.pid
+        self.cv.notify()
+        self.cv.release()
+        for i, task in unstarted: self.transport.done(i, None, -1.0, -1.0, 0, 0, self.en)
+        return pid
+
+    def whack(self):
+        # the task still running after the grace period is killed, and
+        # reported as a possible rogue.
+        self.cv.acquire()
+        i, pid = self.current and self.current[0], self.pid
+        if pid: self.whacked = True
+        self.cv.release()
+        if not pid: return
+        LogI('Task %d: pid %d is being whacked and dummy status generated.'%(i, pid))
+        killGroup(pid, 9)
+        self.transport.done(i, -1, -1.0, -1.0, 1, pid, self.en)
+
+def killGroup(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        try: os.kill(pid, sig)
+        except OSError: pass
+
+class LocalTransport:
+    # --local: tasks run on this host in slots of the driver's own, so
+    # there is no workspace server, launcher or wrapper. each slot is an
+    # engine, numbered from 0, and completions come out as the same
+    # tuples wrappers send.
+    def __init__(self, slots, logFilePath):
+        self.host = socket.gethostname()
+        self.completions = Queue.Queue(0)
+        self.telemetry = Queue.Queue(0)
+        self.unregistered = range(slots)
+        self.engines = {}
+        self.lost = () # slots don't go away.
+        self.logFilePath = logFilePath
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        self.samples = []
+
+    def register(self):
+        return self.host, str(self.unregistered.pop(0)), 0
+
+    def reply(self, en, reply):
+        if not reply.startswith('OK'): return
+        self.engines[en] = LocalEngine(self, en, '%s/%s_%s'%(self.logFilePath, self.host, en))
+        self.engines[en].start()
+
+    def done(self, i, status, startTime, stopTime, rogue, pid, en, usage=None):
+        self.completions.put((i, status, startTime, stopTime, rogue, pid, self.host, en, usage))
+
+    def sendTasks(self, en, tasks):
+        self.engines[en].add(tasks)
+        progress.add('Launched', len(tasks))
+
+    def kill(self, en, i):
+        self.engines[en].kill(i)
+
+    def sendBye(self, engines):
+        # as wrappers do: tasks still running are tickled, then given a
+        # few seconds before they are whacked.
+        engines = [self.engines[en] for en in engines if en in self.engines]
+        for e in engines:
+            pid = e.stop()
+            if pid:
+                LogI('Task on engine %s: pid %d is being tickled.'%(e.en, pid))
+                killGroup(pid, 5)
+        deadline = time.time() + 3
+        for e in engines:
+            e.join(max(deadline - time.time(), 0))
+            if e.isAlive(): e.whack()
+
+    def nextCompletions(self):
+        # block for one completion, then take whatever else is waiting.
+        batch = [self.completions.get(True)]
+        try:
+            while 1: batch.append(self.completions.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def nextTelemetry(self):
+        return self.telemetry.get(True)
+
+    def sample(self, interval):
+        # with --telemetry, this host is sampled by a thread of the driver's.
+        sampler = sqtelemetry.Sampler()
+        while 1:
+            try:
+                s = sampler.sample()
+            except Exception, e:
+                LogW('Telemetry sampling failed, so stopping it: %s'%e)
+                return
+            if s:
+                self.monSem.acquire()
+                self.samples.append(s)
+                full = len(self.samples) >= sqtelemetry.Batch
+                self.monSem.release()
+                if full: self.flushSamples()
+            time.sleep(interval)
+
+    def flushSamples(self):
+        self.monSem.acquire()
+        samples, self.samples = self.samples, []
+        self.monSem.release()
+        if samples: self.telemetry.put((self.host, samples))
+
+    def publish(self, snap, wait=False):
+        pass
+
+    def report(self):
+        pass
+
+    def stop(self):
+        # the samples not yet written, then the end of them.
+        self.flushSamples()
+        self.telemetry.put(None)
+
 class EnginePool:
-    def __init__(self, ws):
+    def __init__(self, transport, prefetch=1, packing=False):
         self.activeEngines = {}
         
         self.draining = False
@@ -84,32 +1449,197 @@ class EnginePool:
         self.en2h = {}
         self.engineQueue = Queue.Queue(0)
 
-        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        # each engine slot may hold up to prefetch tasks (one running,
+        # the rest waiting in its engine's local queue). an engine has a
+        # single slot, unless it is a node agent. an engine goes back on
+        # the engine queue once its backlog drops to half its capacity,
+        # so that its queue is topped up in chunks rather than a task at
+        # a time.
+        self.prefetch = prefetch
+        self.capacity = {}
+        self.queued = set()
+
+        # shared by the dispatcher and the collector, so contention is timed.
+        self.monSem = TimedLock('poolLockWait')       # used to implement monitor-like access to an instance.
 
         self.drainCV = threading.Condition(self.monSem)
 
         self.receivedShutdown = False
 
+        # slot-seconds left idle while the dispatcher had nothing it could
+        # hand out, by what it was waiting for (see TaskStreams.blockedBy).
+        self.busy = 0 # slots with at least one task.
+        self.idleCause, self.idleMark = None, time.time()
+        self.idleTime = {}
+
         # we only learn from this how many engines to expect to hear from.
         ecount = gettasks()
         limit = oArgs.maxTasksPerNode
         h2e = {}
-        wsSem.acquire()
+        regStart = time.time()
         for x in xrange(ecount):
-            eh, en = ws.fetch('engine info')
+            eh, en, slots = transport.register()
             ee = h2e.get(eh, [])
-            if len(ee) < limit:
-                ee.append(en)
-                ws.store('engine %s status'%en, 'OK')
+            if slots:
+                # an agent's slots count against the node's limit.
+                slots = min(slots, limit - len(ee))
+                taken = [en]*slots
+            else:
+                slots, taken = 1, [en]
+            # the first wrapper taken on a node samples it (see --telemetry).
+            reply = 'OK %d%s'%(slots, not ee and ' sample' or '')
+            if taken and len(ee) < limit:
+                ee.extend(taken)
+                t0 = time.time()
+                transport.reply(en, reply)
+                pacer.noteLatency(time.time() - t0)
                 h2e[eh] = ee
                 self.en2h[en] = eh
+                self.capacity[en] = len(taken)*prefetch
                 self.engineQueue.put(en)
+                self.queued.add(en)
                 self.engines[en] = True
             else:
-                ws.store('engine %s status'%en, 'GO AWAY')
-        wsSem.release()
+                transport.reply(en, 'GO AWAY')
 
+        self.slots = sum(self.capacity.values())/prefetch
         LogI('Nodelist: %s' % sorted(h2e.keys()))
+        LogI('%d engines registered in %.1fs, %d slots in all.'%(ecount, time.time() - regStart, self.slots))
+
+        # with packing, tasks are placed by dispatcher on whichever node
+        # has the cores and memory they ask for, rather than on the next
+        # engine off the engine queue, which is not used.
+        self.packing = packing
+        if packing: self.setupPacking(h2e)
+
+        # with more than one attempt at a task possible (--speculate or
+        # --retries), each attempt is tracked, and STATUS says which one
+        # it was.
+        self.tracking = oArgs.speculate or oArgs.retries > 0
+        self.tries = {} # task -> attempts launched.
+        self.copies = {} # task -> {engine: (attempt, launch time)} of attempts out.
+        self.settled = {} # task -> command, for tasks decided with copies still out.
+        self.copied = set() # tasks given a speculative copy.
+        self.runtimes = [] # of successful attempts.
+        self.retries = [] # heap of (when due, task) for failed tasks to try again.
+        self.avoid = {} # task -> nodes it failed on (see --retryElsewhere).
+        self.demand = {} # task -> (cores, memory), when packing.
+
+    def setupPacking(self, h2e):
+        cpus = int(os.getenv('SLURM_CPUS_PER_TASK', '1'))
+        self.hostEngines, self.hostCores, self.hostMem = {}, {}, {}
+        for h, ee in h2e.items():
+            self.hostEngines[h] = sorted(set(ee))
+            # a node's cores are those of the engine slots on it.
+            cores = oArgs.nodeCores or len(ee)*cpus
+            if oArgs.nodeMem:
+                mem = memMB(oArgs.nodeMem)
+            elif os.getenv('SLURM_MEM_PER_NODE'):
+                mem = int(os.getenv('SLURM_MEM_PER_NODE'))
+            elif os.getenv('SLURM_MEM_PER_CPU'):
+                mem = int(os.getenv('SLURM_MEM_PER_CPU'))*cores
+            else:
+                mem = sys.maxint
+            self.hostCores[h], self.hostMem[h] = cores, mem
+            LogI('Node %s: %d engine(s), %d cores, %s memory.'%(h, len(self.hostEngines[h]), cores, mem == sys.maxint and 'unlimited' or '%dMB'%mem))
+        self.freeCores, self.freeMem = dict(self.hostCores), dict(self.hostMem)
+        self.reserved = {} # task -> (host, cores, memory).
+        self.usedCores, self.coreTime, self.coreMark = 0, 0., time.time()
+        self.packStart = time.time()
+
+    def fitsAnywhere(self, cores, mem):
+        for h in self.hostCores:
+            if cores <= self.hostCores[h] and mem <= self.hostMem[h]: return True
+        return False
+
+    def place(self, i, cores, mem):
+        # an engine for task i on the node it fits most tightly, with the
+        # cores and memory reserved; None if it fits nowhere right now, or
+        # -1 when shutting down.
+        self.monSem.acquire()
+        try:
+            if self.receivedShutdown: return -1
+            if self.busy >= self.slots: return None
+            best, bestEn = None, None
+            for h in self.hostEngines:
+                if self.freeCores[h] < cores or self.freeMem[h] < mem: continue
+                if best != None and self.freeCores[h] >= self.freeCores[best]: continue
+                for en in self.hostEngines[h]:
+                    if len(self.activeEngines.get(en, [])) < self.capacity[en] and en not in transport.lost: break
+                else:
+                    continue
+                best, bestEn = h, en
+            if best == None: return None
+            self.accrueCores()
+            self.freeCores[best] -= cores
+            self.freeMem[best] -= mem
+            self.usedCores += cores
+            self.reserved[i] = (best, cores, mem)
+            if self.tracking: self.demand[i] = (cores, mem)
+            return bestEn
+        finally:
+            self.monSem.release()
+
+    def unreserve(self, i):
+        # must be called with monSem held.
+        r = self.reserved.pop(i, None)
+        if not r: return
+        self.accrueCores()
+        h, cores, mem = r
+        self.freeCores[h] += cores
+        self.freeMem[h] += mem
+        self.usedCores -= cores
+
+    def accrueCores(self):
+        # must be called with monSem held, before usedCores changes.
+        now = time.time()
+        self.coreTime += self.usedCores*(now - self.coreMark)
+        self.coreMark = now
+
+    def packReport(self):
+        self.monSem.acquire()
+        self.accrueCores()
+        elapsed = max(time.time() - self.packStart, 1e-6)
+        LogI('Packing: tasks held %.1f%% of the nodes\' %d cores on average.'%(100*self.coreTime/elapsed/max(sum(self.hostCores.values()), 1), sum(self.hostCores.values())))
+        self.monSem.release()
+
+    def busySlots(self, en):
+        # must be called with monSem held.
+        return min(len(self.activeEngines.get(en, [])), self.capacity[en]/self.prefetch)
+
+    def accrueIdle(self):
+        # must be called with monSem held, before busy or idleCause change.
+        now = time.time()
+        if self.idleCause:
+            self.idleTime[self.idleCause] = self.idleTime.get(self.idleCause, 0.) + (self.slots - self.busy)*(now - self.idleMark)
+        self.idleMark = now
+
+    def setIdleCause(self, cause):
+        self.monSem.acquire()
+        self.accrueIdle()
+        self.idleCause = cause
+        self.monSem.release()
+
+    def idleReport(self):
+        self.monSem.acquire()
+        self.accrueIdle()
+        LogI('Idle slot time while tasks were held back: %s.'%', '.join(['%.1fs by %s'%(self.idleTime.get(c, 0.), c) for c in ['dependencies', 'DRAINs', 'input', 'packing']]))
+        self.monSem.release()
+
+    def status(self):
+        # per node, for the status server: engines, slots, slots busy and tasks held.
+        self.monSem.acquire()
+        hosts = {}
+        for en in self.engines:
+            h = hosts.setdefault(self.en2h[en], {'engines': 0, 'slots': 0, 'busy': 0, 'tasks': 0})
+            h['engines'] += 1
+            h['slots'] += self.capacity[en]/self.prefetch
+            h['busy'] += self.busySlots(en)
+            h['tasks'] += len(self.activeEngines.get(en, []))
+        snap = {'hosts': hosts, 'slots': self.slots, 'busy': self.busy, 'waitingFor': self.idleCause,
+                'shuttingDown': self.receivedShutdown}
+        self.monSem.release()
+        return snap
 
     def drainPool(self):
         # wait for all assigned tasks to finish. this uses mon sem
@@ -120,34 +1650,193 @@ class EnginePool:
         self.draining = False
         self.drainCV.release()
 
-    def getEngine(self, taskIndex):
-        # return an engine that can be assigned a new task --- block if
-        # necessary for one to become available.
+    def getEngine(self):
+        # return an engine that can be assigned new tasks, along with
+        # the number of tasks it can take --- block if necessary for
+        # one to become available.
+        t0 = time.time()
         en = self.engineQueue.get(True)
+        metrics.observe('engineWait', time.time() - t0)
         if en == -1:
             self.engineQueue.put(en)
-        else:
-            self.monSem.acquire()
-            if self.draining:
-                LogI('Got an engine while draining!!!')
-            self.activeEngines[en] = taskIndex
+            return en, 0
+
+        self.monSem.acquire()
+        if self.draining:
+            LogI('Got an engine while draining!!!')
+        free = self.capacity[en] - len(self.activeEngines.get(en, []))
+        self.monSem.release()
+
+        return en, free
+
+    def requeue(self, en):
+        # must be called with monSem held.
+        # an engine whose connection has gone gets nothing more.
+        if en in self.queued or self.receivedShutdown or self.packing or en in transport.lost: return
+        if len(self.activeEngines.get(en, [])) <= self.capacity[en]/2:
+            self.queued.add(en)
+            self.engineQueue.put(en)
+
+    def assignTasks(self, en, indices):
+        self.monSem.acquire()
+        self.accrueIdle()
+        self.busy -= self.busySlots(en)
+        self.activeEngines.setdefault(en, []).extend(indices)
+        if self.tracking:
+            now = time.time()
+            for i in indices:
+                self.tries[i] = self.tries.get(i, 0) + 1
+                self.copies.setdefault(i, {})[en] = (self.tries[i], now)
+        self.busy += self.busySlots(en)
+        self.queued.discard(en)
+        self.requeue(en)
+        self.monSem.release()
+
+    def settle(self, i, en, ok, task=None):
+        # the attempt at task i on engine en is over. returns its number,
+        # whether it decides the task, the engines with copies of it to
+        # stop, and the delay before another attempt, if there is to be one.
+        self.monSem.acquire()
+        try:
+            copies = self.copies.get(i, {})
+            attempt = copies.pop(en, (1, 0))[0]
+            if i in self.settled:
+                # another copy decided it already.
+                if not copies: self.forget(i)
+                return attempt, False, [], None
+            if copies and not ok:
+                # the others may yet succeed.
+                return attempt, False, [], None
+            if copies:
+                self.settled[i] = task
+                return attempt, True, copies.keys(), None
+            if not ok and self.tries.get(i, 1) <= oArgs.retries and not self.receivedShutdown:
+                delay = oArgs.retryDelay*2**(self.tries.get(i, 1) - 1)
+                if oArgs.retryElsewhere:
+                    avoid = self.avoid.setdefault(i, set())
+                    avoid.add(self.en2h[en])
+                    # with nowhere else to go, it goes anywhere.
+                    if avoid >= set(self.en2h.values()): avoid.clear()
+                heapq.heappush(self.retries, (time.time() + delay, i))
+                return attempt, False, [], delay
+            self.forget(i)
+            return attempt, True, [], None
+        finally:
+            self.monSem.release()
+
+    def dueRetries(self):
+        # [(task, nodes to avoid)] for the retries that are due.
+        self.monSem.acquire()
+        due, now = [], time.time()
+        while self.retries and self.retries[0][0] <= now:
+            i = heapq.heappop(self.retries)[1]
+            due.append((i, self.avoid.get(i, set())))
+        self.monSem.release()
+        return due
+
+    def deferRetry(self, i, delay=1.):
+        # no engine could take it just now.
+        self.monSem.acquire()
+        heapq.heappush(self.retries, (time.time() + delay, i))
+        self.monSem.release()
+
+    def retryWait(self, default=None):
+        # how long until the next retry is due.
+        self.monSem.acquire()
+        wait = self.retries and max(self.retries[0][0] - time.time(), 0.01) or default
+        self.monSem.release()
+        return wait
+
+    def giveUp(self, i):
+        self.monSem.acquire()
+        self.forget(i)
+        self.monSem.release()
+
+    def forget(self, i):
+        # must be called with monSem held.
+        self.copies.pop(i, None)
+        self.tries.pop(i, None)
+        self.settled.pop(i, None)
+        self.copied.discard(i)
+        self.avoid.pop(i, None)
+        self.demand.pop(i, None)
+
+    def settledTask(self, i):
+        self.monSem.acquire()
+        task = self.settled.get(i)
+        self.monSem.release()
+        return task
+
+    def noteRuntime(self, t):
+        self.monSem.acquire()
+        self.runtimes.append(t)
+        self.monSem.release()
+
+    def stragglers(self):
+        # (task, engine, node) for tasks running alone well past the
+        # median runtime, longest running first.
+        self.monSem.acquire()
+        try:
+            if len(self.runtimes) < SpeculateAfter: return []
+            self.runtimes.sort()
+            limit = max(SpeculateFactor*self.runtimes[len(self.runtimes)/2], SpeculateMin)
+            now, late = time.time(), []
+            for i, copies in self.copies.items():
+                if len(copies) != 1 or i in self.copied or i in self.settled: continue
+                en, (attempt, t0) = copies.items()[0]
+                if now - t0 > limit: late.append((t0, i, en, self.en2h[en]))
+            late.sort()
+            return [(i, en, h) for t0, i, en, h in late]
+        finally:
+            self.monSem.release()
+
+    def spareEngine(self, avoid, exclude=None):
+        # an engine other than exclude with a free slot on a node not in
+        # avoid, or None.
+        self.monSem.acquire()
+        try:
+            if self.receivedShutdown: return None
+            for en in self.engines:
+                if en == exclude or self.en2h[en] in avoid or en in transport.lost: continue
+                if len(self.activeEngines.get(en, [])) < self.capacity[en]/self.prefetch: return en
+            return None
+        finally:
             self.monSem.release()
 
-        return en
+    def waitIdle(self, timeout):
+        # wait up to timeout for all tasks to finish. True if they have,
+        # with none waiting to be retried.
+        self.drainCV.acquire()
+        if self.activeEngines or self.retries: self.drainCV.wait(timeout)
+        idle = not (self.activeEngines or self.retries)
+        self.drainCV.release()
+        return idle
 
-    def releaseNode(self, engineNum, tStream, i, completed=True):
+    def releaseNodes(self, streams, released):
+        # released is a list of (engineNum, taskIndex, completed, final),
+        # where final is False for an attempt that did not decide the
+        # task (see settle).
         self.monSem.acquire()
-        LogI('Releasing %s (%s) for task %d (%s).'%(engineNum, self.en2h[engineNum], i, completed))
+        self.accrueIdle()
+        for engineNum, i, completed, final in released:
+            LogI('Releasing %s (%s) for task %d (%s).'%(engineNum, self.en2h[engineNum], i, completed))
+
+            self.busy -= self.busySlots(engineNum)
+            backlog = self.activeEngines[engineNum]
+            backlog.remove(i)
+            if not backlog: self.activeEngines.pop(engineNum)
+            self.busy += self.busySlots(engineNum)
+            if self.packing: self.unreserve(i)
+            if final: streams.release(i, completed)
+            self.requeue(engineNum)
 
-        self.activeEngines.pop(engineNum)
-        if completed: tStream.setDone(i)
         if self.draining:
             if not self.activeEngines:
                 LogI('Notify drainCV.')
                 self.drainCV.notify()
-
-        if not self.receivedShutdown:
-            self.engineQueue.put(engineNum)
+        elif self.tracking and not self.activeEngines:
+            # see waitIdle.
+            self.drainCV.notify()
 
         self.monSem.release()
 
@@ -173,97 +1862,412 @@ class EnginePool:
 
         # since this can trigger engine releases, we prefer not to do it while holding the monitor.
         if doPoisonTasks:
-            wsSem.acquire()
-            for en in self.engines:
-                ws.store('engine %s task'%en, (-1, 'bye'))
-            wsSem.release()
+            transport.sendBye(self.engines)
         LogI('Poison tasks sent.')
             
         
-def runTask(ep, en, tStream, i, task, key):
-    task = task.strip()
-    if task[0] in '\'"':
-        LogW('removing quotes from: '+task)
-        task = task[1:-1]
-
-    LogI('Launching on %s (%s): %s'%(en, ep.en2h[en], task))
-    tStream.setInflight(i, (en, ep.en2h[en], task))
-    wsSem.acquire()
-    ws.store('engine %s task'%en, (i, task))
-    ws.store('Launched', str(int(ws.fetch('Launched'))+1))
-    wsSem.release()
-        
-    # be careful in the following not to block or blow up.
-    wsSem.acquire()
-    try:
-        me = 'Task %d Status'%i
-        LogI('Fetching extra data for task %d from workspace.'%i)
-        while 1:
-            status, startTime, stopTime, rogue, pid, host, engineNum = ws.fetchTry(me, (-1, -1., -1., True, -1, 'no where', -1))
-            if pid != -1: break
-            wsSem.release()
-            time.sleep(FetchDelay)
-            wsSem.acquire()
-        try:    ws.deleteVar(me)
-        except: pass
-        if status != None: status = divmod(status, 256)
-        LogI('Extra data for task %d from workspace: %s %f %f %s %d %s'%(i, status, startTime, stopTime, rogue, pid, host))
-        taskStatus.write('%d\t%s\t%f\t%f\t%d\t%d\t%s\t%s\n'%(i, status, startTime, stopTime, rogue, pid, host, task))
-        if rogue:
-            # "borrowing" the wsSem to protect this write.
-            taskRogues.write('%s\t%d\n'%(host, pid))
-        ws.store('Done', str(int(ws.fetch('Done')) + 1))
-        if status == 0:
-            ws.store('Succeeded', str(int(ws.fetch('Succeeded')) + 1))
+def dispatchChunk(ep, en, streams, chunk, key):
+    t0 = time.time()
+    tasks = []
+    for i, task in chunk:
+        if task.strip()[0] in '\'"': LogW('removing quotes from: '+task)
+        task = unquote(task)
+
+        LogI('Launching on %s (%s): %s'%(en, ep.en2h[en], task))
+        streams.setInflight(i, (en, ep.en2h[en], t0, task))
+        tasks.append((i, task))
+
+    ep.monSem.acquire()
+    if ep.receivedShutdown:
+        # the poison tasks have gone (or are going) out, so nobody will
+        # pick these up. leave them in flight so they land in REMAINING.
+        ep.monSem.release()
+        LogI('Not launching tasks %s: shutting down.'%[i for i, task in tasks])
+        ep.releaseNodes(streams, [(en, i, False, not ep.tracking or ep.settle(i, en, False)[1]) for i, task in tasks])
+        return
+    # posting under the monitor orders this before any poison tasks.
+    transport.sendTasks(en, tasks)
+    ep.monSem.release()
+    metrics.observe('dispatch', time.time() - t0)
+
+def statusLine(x, status, startTime, stopTime, rogue, pid, host, usage, attempt, task):
+    # unless --classicStatus, the task's resource usage (see
+    # SQDedWrapper.waitTask) follows the node, '-' if there is none. the
+    # attempt, if any (see EnginePool.settle), comes just before the task.
+    fields = ['%d'%x, '%s'%(status,), '%f'%startTime, '%f'%stopTime, '%d'%rogue, '%d'%pid, host]
+    if not oArgs.classicStatus:
+        if usage:
+            fields += ['%.3f'%usage[0], '%.3f'%usage[1]] + ['%d'%u for u in usage[2:]]
         else:
-            ws.store('Failed', str(int(ws.fetch('Failed')) + 1))
-    except Exception, e:
-        LogI('Encountered exception "%s" while accessing extra status info for task %d.'%(e, i))
-    wsSem.release()
-        
-    if status == (0, 0):
-        # Everything OK.
-        ep.releaseNode(engineNum, tStream, i)
-    elif status and status[0] == 0 and oArgs.ignoreErrors:
-        # Means the task exited with a non-zero exit code, but we've been told to ignore that.
-        ep.releaseNode(engineNum, tStream, i)
+            fields += ['-']*6
+    if attempt: fields.append('%d'%attempt)
+    return '\t'.join(fields + [task]) + '\n'
+
+def killCopies(ep, i, engines):
+    # another copy of task i has decided it.
+    for en in engines:
+        LogI('Stopping the copy of task %d on %s (%s).'%(i, en, ep.en2h[en]))
+        transport.kill(en, i)
+
+def storeTasks(conn, en, tasks):
+    t0 = time.time()
+    # a single task is sent as before, a chunk as a list of tasks.
+    if len(tasks) == 1:
+        conn.store('engine %s task'%en, tasks[0])
     else:
-        # Either the task was terminated, it exited with a non-zero
-        # code which we are not ignoring, or it may be a rogue. Flag
-        # as incomplete.
-        ep.releaseNode(engineNum, tStream, i, completed=False)
+        conn.store('engine %s task'%en, tasks)
+    pacer.noteLatency(time.time() - t0)
+    progress.add('Launched', len(tasks))
+
+def storeKill(conn, en, i):
+    conn.store('engine %s task'%en, (-2, i))
+
+def sendPoison(conn, engines):
+    for en in engines:
+        conn.store('engine %s task'%en, (-1, 'bye'))
 
-def runTasks(ep, tStream, key):
+def collectCompletions(ep, streams):
+    # the only reader of the completion channel. whatever has queued up
+    # behind the status it waited for is handled in the same pass.
+    while 1:
+        try:
+            batch = transport.nextCompletions()
+        except Exception, e:
+            LogE('Lost the completion channel: %s'%e)
+            return
+
+        received = time.time()
+        released, finished = [], []
+        done, succeeded = 0, 0
+        retrying = False
+        # be careful in the following not to blow up.
+        for st in batch:
+            try:
+                i, status, startTime, stopTime, rogue, pid, host, engineNum = st[:8]
+                usage = len(st) > 8 and st[8] or None
+                ts, x = streams.locate(i)
+                info = ts.getInflight(x)
+                task = info and info[-1]
+                # a copy that lost (see --speculate) comes in after its task is done.
+                if task == None and ep.tracking: task = ep.settledTask(i)
+                if task == None:
+                    LogW('Ignoring status for task %d, which is not in flight: %s'%(i, repr(st)))
+                    continue
+                if status == None and startTime < 0:
+                    # the engine was told to quit before getting to this one.
+                    LogI('Task %d was never started.'%i)
+                    final = True
+                    if ep.tracking:
+                        final, delay = ep.settle(i, engineNum, False)[1::2]
+                        if delay != None: retrying = True
+                    released.append((engineNum, i, False, final))
+                    continue
+                # these lags span the driver's and the node's clocks, so
+                # are only noted when skew hasn't made them negative.
+                if info and info[2] and startTime >= info[2]: metrics.observe('startLag', startTime - info[2])
+                if stopTime >= 0 and received >= stopTime: metrics.observe('completionLag', received - stopTime)
+                if status != None: status = divmod(status, 256)
+                # anything else means the task was terminated, exited with a
+                # non-zero code which we are not ignoring, or may be a rogue.
+                # it is flagged as incomplete.
+                ok = status == (0, 0) or (status and status[0] == 0 and oArgs.ignoreErrors)
+                attempt, final, losers, delay = 1, True, [], None
+                if ep.tracking:
+                    attempt, final, losers, delay = ep.settle(i, engineNum, ok, task)
+                    if delay != None:
+                        LogI('Task %d failed on attempt %d: trying again in %gs.'%(i, attempt, delay))
+                        retrying = True
+                    if ok and 0 <= startTime <= stopTime: ep.noteRuntime(stopTime - startTime)
+                LogI('Extra data for task %d from workspace: %s %f %f %s %d %s'%(i, status, startTime, stopTime, rogue, pid, host))
+                ts.taskStatus.write(statusLine(x, status, startTime, stopTime, rogue, pid, host, usage, ep.tracking and attempt, task))
+                if deadline and status != None and 0 <= startTime <= stopTime: deadline.note(task, stopTime - startTime)
+                if rogue:
+                    ts.taskRogues.write('%s\t%d\n'%(host, pid))
+                if losers: killCopies(ep, i, losers)
+                if final:
+                    done += 1
+                    if status == (0, 0): succeeded += 1
+            except Exception, e:
+                LogI('Encountered exception "%s" while handling status %s.'%(e, repr(st)))
+                continue
+
+            released.append((engineNum, i, ok, final))
+            if ok and final: finished.append((ts, x, task))
+
+        if done:
+            progress.add('Done', done)
+            progress.add('Succeeded', succeeded)
+            progress.add('Failed', done - succeeded)
+
+        for ts in streams.streams:
+            try:
+                ts.journal.record([(x, task) for fts, x, task in finished if fts is ts])
+            except Exception, e:
+                LogE('Could not write to the journal: %s'%e)
+        ep.releaseNodes(streams, released)
+        # the dispatcher may be waiting with nothing due.
+        if retrying: streams.poke()
+        metrics.observe('completionHandling', time.time() - received)
+
+def collectTelemetry(fileName):
+    # node samples (see sqtelemetry.py), one line each, as they come in.
+    f = open(fileName, 'w')
+    f.write('\t'.join(sqtelemetry.Fields[:1] + ['host'] + sqtelemetry.Fields[1:]) + '\n')
+    f.flush()
+    while 1:
+        try:
+            batch = transport.nextTelemetry()
+        except Exception, e:
+            LogI('Stopped collecting telemetry: %s'%e)
+            break
+        # the transport has no more (see LocalTransport.stop).
+        if batch == None: break
+        host, samples = batch
+        f.write(''.join([sqtelemetry.formatSample(host, s) for s in samples]))
+        f.flush()
+    f.close()
+
+def runTasks(ep, streams, key):
     allLaunched = False
-    # TODO: this could now block, e.g. if the task file is a named
-    # pipe. overall flow needs to be modified to handle blocking here
-    # correctly.
-    for i, task in tStream:
+    en, free, chunk = -1, 0, []
+    # when packing, tasks that don't fit anywhere yet wait here, oldest
+    # first, for releases to make room (see EnginePool.place).
+    pending = []
+    # getEngine, the choice of stream, DRAINs and the dispatch itself
+    # all happen in this one thread.
+    while 1:
+        while not free and not ep.packing:
+            # an engine given a retry (see dispatchRetries) may turn up
+            # here with no room left; it is passed over.
+            en, free = ep.getEngine()
+            if en == -1: break
+        if en == -1 and not ep.packing: break
+        if ep.retries:
+            free = dispatchRetries(ep, streams, key, en, free)
+            if not free and not ep.packing:
+                # retries took the rest of en's room: what was gathered
+                # for it goes out now, not with the next engine's chunk.
+                if chunk:
+                    launchChunk(ep, en, streams, chunk, key)
+                    chunk = []
+                continue
+        try:
+            got = streams.next()
+        except StopIteration:
+            if chunk: launchChunk(ep, en, streams, chunk, key)
+            if pending and not fillPending(ep, streams, pending, key, 0):
+                LogI('Stopped placing tasks: shutting down.')
+                break
+            if streams.interrupted:
+                LogI('Stopped reading tasks: shutting down.')
+            else:
+                LogI('All tasks launched.')
+            allLaunched = True
+            if ep.tracking and not streams.interrupted: finishTail(ep, streams, key)
+            break
+        if got == None:
+            # nothing is ready for now (input has run dry, or streams are
+            # held at DRAINs): don't sit on a partial chunk meanwhile.
+            if chunk:
+                launchChunk(ep, en, streams, chunk, key)
+                chunk, free = [], 0
+            if pending and placePending(ep, streams, pending, key) == -1: break
+            ep.setIdleCause(streams.blockedBy())
+            streams.wait(ep.retryWait())
+            ep.setIdleCause(None)
+            continue
+        ts, i, task = got
         if task.startswith('#SQ_OP'):
             op = task.split()
             if len(op) == 2 and op[1].upper() == 'DRAIN':
-                LogI('Initiating drain (%d).'%i)
-                ep.drainPool()
-                LogI('Done drain (%d).'%i)
-                #tStream.setDone(i) # don't do this --- it's not a real task.
+                # whatever has been gathered for the current engine must
+                # go out before the barrier.
+                if chunk:
+                    launchChunk(ep, en, streams, chunk, key)
+                    chunk, free = [], 0
+                if pending and not fillPending(ep, streams, pending, key, 0): break
+                LogI('Initiating drain (%s).'%streams.name(i))
+                streams.drain(ts, i)
+                #streams.setDone(i) # don't do this --- it's not a real task.
             else:
                 LogW('Ignoring unrecognized SimpleQueue operation: %s'%task)
             continue
-        # must call getEngine in this context *before* thread is
-        # created. this serializes calls to getEngine, as well as
-        # calls to drainPool.
-        en = ep.getEngine(i)
-        if en == -1: break
-        thread.start_new_thread(runTask, (ep, en, tStream, i, task, key))
-        time.sleep(LaunchDelay)
-    else:
-        LogI('All tasks launched.')
-        allLaunched = True
+        if deadline:
+            fits, est = deadline.fits(task)
+            if not fits:
+                if deadline.over():
+                    # what was gathered may still make it.
+                    if chunk: launchChunk(ep, en, streams, chunk, key)
+                    streams.setInflight(i, (None, None, None, task))
+                    LogI('No more tasks can finish before the deadline (%s): not starting any more.'%time.ctime(deadline.end))
+                    break
+                LogI('Not starting task %s, which would take about %.0fs: too close to the deadline.'%(streams.name(i), est))
+                deadline.skipped += 1
+                streams.setInflight(i, (None, None, None, task))
+                streams.assigned([i])
+                streams.release(i, False)
+                continue
+        if ep.packing:
+            cores, mem = streams.resources(i)
+            if not ep.fitsAnywhere(cores, mem):
+                LogE('Task %s asks for %d cores and %dMB, more than any node has: not running it.'%(streams.name(i), cores, mem))
+                streams.setInflight(i, (None, None, None, task))
+                streams.assigned([i])
+                streams.release(i, False)
+                continue
+            pending.append((i, task, cores, mem))
+            if not fillPending(ep, streams, pending, key, PackWindow-1): break
+            continue
+        chunk.append((i, task))
+        free -= 1
+        if not free:
+            launchChunk(ep, en, streams, chunk, key)
+            chunk = []
 
-    if not allLaunched: LogI('Looks like we\'re shutting down, so skipping tasks from index %d on.'%i)
+    # tasks that were never placed are written to REMAINING.
+    for i, task, cores, mem in pending: streams.setInflight(i, (None, None, None, task))
+    if not allLaunched: LogI('Looks like we\'re shutting down, so skipping the tasks not yet launched.')
+    if deadline and deadline.skipped: LogI('Skipped %d task(s) that would not have finished before the deadline.'%deadline.skipped)
+    if ep.packing: ep.packReport()
+    for ts in streams.streams:
+        if ts.skipped: LogI('Skipped %d task(s) of %s already done according to the journal.'%(ts.skipped, ts.spec))
+    pacer.report(final=True)
+    transport.report()
+    ep.idleReport()
     LogI('Draining pool.')
     ep.drainPool()
 
+def placePending(ep, streams, pending, key):
+    # launch whichever pending tasks fit somewhere now, oldest first.
+    # returns -1 when shutting down.
+    for t in list(pending):
+        i, task, cores, mem = t
+        en = ep.place(i, cores, mem)
+        if en == -1: return -1
+        if en == None: continue
+        pending.remove(t)
+        launchChunk(ep, en, streams, [(i, task)], key)
+
+def fillPending(ep, streams, pending, key, limit):
+    # place pending tasks until no more than limit are left waiting.
+    # False when shutting down.
+    while 1:
+        streams.mark()
+        if placePending(ep, streams, pending, key) == -1: return False
+        if len(pending) <= limit: return True
+        ep.setIdleCause('packing')
+        streams.wait()
+        ep.setIdleCause(None)
+        if streams.interrupted: return False
+
+def dispatchRetries(ep, streams, key, en, free):
+    # launch the retries that are due: on en (the engine the dispatcher
+    # holds, with free slots) if they may go there, else on any other
+    # engine with room on a node they are not avoiding. returns what is
+    # left of free.
+    for i, avoid in ep.dueRetries():
+        task = streams.getTask(i)
+        if task == None: continue
+        if deadline and not deadline.fits(task)[0]:
+            LogI('Not retrying task %s: too close to the deadline.'%streams.name(i))
+            ep.giveUp(i)
+            streams.release(i, False)
+            continue
+        if ep.packing:
+            cores, mem = ep.demand.get(i, DefaultResources)
+            target = ep.place(i, cores, mem)
+            if target == -1: return free
+        elif en != -1 and free and ep.en2h[en] not in avoid:
+            target = en
+            free -= 1
+        else:
+            target = ep.spareEngine(avoid, en)
+        if target == None:
+            ep.deferRetry(i)
+            continue
+        LogI('Retrying task %s on %s (%s).'%(streams.name(i), target, ep.en2h[target]))
+        ep.assignTasks(target, [i])
+        dispatchChunk(ep, target, streams, [(i, task)], key)
+    return free
+
+def finishTail(ep, streams, key):
+    # with everything launched, retries go out as they fall due. and
+    # with --speculate, as engines would otherwise sit idle while the
+    # last tasks finish, a task running far longer than most gets a copy
+    # on another node; whichever copy succeeds first decides it, and the
+    # other is stopped (see collectCompletions).
+    if oArgs.speculate: LogI('Watching for stragglers.')
+    copies = 0
+    while not ep.waitIdle(ep.retryWait(SpeculateInterval)):
+        if ep.retries: dispatchRetries(ep, streams, key, -1, 0)
+        if not oArgs.speculate: continue
+        for i, en, h in ep.stragglers():
+            spare = ep.spareEngine([h])
+            if spare == None: break
+            task = streams.getTask(i)
+            if task == None: continue
+            ep.monSem.acquire()
+            ep.copied.add(i)
+            ep.monSem.release()
+            LogI('Task %s has been on %s (%s) for a long time: starting a copy on %s (%s).'%(streams.name(i), en, h, spare, ep.en2h[spare]))
+            ep.assignTasks(spare, [i])
+            dispatchChunk(ep, spare, streams, [(i, task)], key)
+            copies += 1
+    if oArgs.speculate: LogI('Started %d speculative cop%s.'%(copies, copies == 1 and 'y' or 'ies'))
+
+def launchChunk(ep, en, streams, chunk, key):
+    indices = [i for i, task in chunk]
+    ep.assignTasks(en, indices)
+    streams.assigned(indices)
+    dispatchChunk(ep, en, streams, chunk, key)
+    pacer.pace()
+
+def runStatus():
+    # the run as the status server reports it, all from the driver's own
+    # state: no workspace operations. the projected finish is only made
+    # while every task file's size is known, i.e., no input is streamed.
+    counts, overall, recent = progress.rates()
+    files = streams.status()
+    now = time.time()
+    snap = {'time': now, 'started': progress.startTime, 'counts': counts,
+            'rate': overall, 'recentRate': recent, 'rateWindow': RateWindow,
+            'files': files, 'pool': ep.status(), 'finishing': goodbye,
+            'deadline': deadline and deadline.cutoff or None,
+            'remaining': None, 'eta': None}
+    if not [f for f in files if f['tasks'] == None]:
+        remaining = sum([max(f['tasks'] - f['done'], 0) for f in files])
+        snap['remaining'] = remaining
+        rate = recent or overall
+        if not remaining:
+            snap['eta'] = now
+        elif rate:
+            snap['eta'] = now + remaining/rate
+    return snap
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # GET /status (or /) for runStatus, /metrics for the latest Metrics
+    # snapshot, as JSON.
+    timeout = 10
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path in ('', '/status'):
+            body = runStatus()
+        elif path == '/metrics':
+            body = metrics.snapshot()
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(body, sort_keys=True, indent=1, separators=(',', ': ')) + '\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LogD('Status request from %s: %s'%(self.client_address[0], format%args))
+
 def setupLogging(logLevel, logFile):
     logging.basicConfig(level=logLevel,
                         filename=logFile,
@@ -288,79 +2292,206 @@ if '__main__' == __name__:
         setattr(parser.values, option.dest, value)
 
     opts = optparse.OptionParser(description='Process a simple queue of tasks using a dedicated collection of nodes.',
-                                 usage='usage: %prog [options] TaskFile')
+                                 usage='usage: %prog [options] TaskFile[@Priority] ...\n\nTaskFile may also be a named pipe, - (stdin) or tcp:[Host:]Port, to run tasks as they are written to it. With several task files, free engines take tasks from the highest priority (default 0) one that has any ready; files of equal priority take turns.')
+    opts.add_option('--classicStatus', help='Leave the resource usage columns out of STATUS.', action='store_true', default=False)
     opts.add_option('-H', '--nwssHost', help='nws server host (%default).', action='callback', callback=monitor_store, metavar='Host', default='localhost') 
+    opts.add_option('--deadline', help='When the allocation ends, in seconds since the epoch. Tasks that would not finish SQDeadlineMargin (60) seconds before then are not started, and the run stops at that point.', metavar='Time', type='float', default=0)
+    opts.add_option('--history', help='With longestFirst, comma separated list of STATUS files of earlier runs to take runtimes from, besides the ones this run will replace.', metavar='FileList', default='')
     opts.add_option('-i', '--ignoreErrors', help='Consider a task done even if it returns an error code.', action='store_true', default=False)
     opts.add_option('-l', '--logFile', help='Specify log file name (%default).', metavar='LogFile', default='log.out') 
+    opts.add_option('--local', help='Run the tasks on this host, N at a time, in the driver itself, with no workspace server, launcher or wrappers (0: don\'t).', metavar='N', type='int', default=0)
+    opts.add_option('--longestFirst', help='Between DRAINs, run the tasks that took longest in earlier runs first (see history).', action='store_true', default=False)
     opts.add_option('--maxTasksPerNode', help='When running with PBS, limit tasks to N per node.',  metavar='N', type='int', default=1000000) 
+    opts.add_option('--nodeAgents', help='Start one wrapper per node, running as many tasks at once as Slurm allotted to the node, instead of one wrapper per task.', action='store_true', default=False)
+    opts.add_option('--nodeCores', help='With packResources, the number of cores on each node (default: the engine slots on the node times SLURM_CPUS_PER_TASK).', metavar='N', type='int', default=0)
+    opts.add_option('--nodeMem', help='With packResources, the memory on each node, e.g. 64G (default: from SLURM_MEM_PER_NODE or SLURM_MEM_PER_CPU, else not limited).', metavar='Size', default=None)
     opts.add_option('-n', '--nodeFiles', help='Comma separated list of files listing nodes to use (%default).', metavar='FileList', default='$PBS_NODEFILE')
+    opts.add_option('--prefetch', help='Number of tasks each engine may hold at once, the first running and the rest queued locally (%default).', metavar='K', type='int', default=1)
     opts.add_option('-p', '--nwssPort', help='nws server port (%default).', action='callback', callback=monitor_store, metavar='Port', type='int', default='8765') 
+    opts.add_option('--packResources', help='Place each task on a node with the cores and memory it asks for (see RESOURCES and #SQ_RES in the README), running several on a node as they fit. Implies --prefetch=1.', action='store_true', default=False)
     opts.add_option('--pnwss', help='Create a personal workspace for this run.', action='store_true', default=False)
+    opts.add_option('--resume', help='Skip tasks that the journal (TaskFile.JOURNAL) of an earlier run of this task file records as done, and add to that journal rather than starting a new one.', action='store_true', default=False)
+    opts.add_option('--retries', help='Number of times to try a failed task again during the run (%default).', metavar='N', type='int', default=0)
+    opts.add_option('--retryDelay', help='Seconds to wait before the first retry of a task, doubling for each one after (%default).', metavar='Seconds', type='float', default=10)
+    opts.add_option('--retryElsewhere', help='Retry a failed task on a node it has not failed on, if there is one.', action='store_true', default=False)
+    opts.add_option('--speculate', help='Once all tasks are launched, start a copy of a task that has run much longer than most on another node, and keep whichever finishes first (see SQSpeculateFactor).', action='store_true', default=False)
+    opts.add_option('--statusPort', help='Port for an HTTP status server, whose address is written to status.address in the log directory (0: any free port; -1: no server, the default). It answers anyone who can reach the port.', metavar='Port', type='int', default=-1)
+    opts.add_option('--telemetry', help='Have each node sample its load, cpu, memory and i/o every this many seconds, written to telemetry.tsv in the log directory (0: don\'t).', metavar='Seconds', type='float', default=0)
+    opts.add_option('--transport', help='How the driver and engines talk: through an nws server, or directly over the driver\'s own sockets (%default).', type='choice', choices=['nws', 'native'], default='nws')
+    opts.add_option('--wsPoolSize', help='Number of workspace connections used for dispatch (%default).', metavar='N', type='int', default=4)
     opts.add_option('-v', '--verbose', action='store_const', const=logging.DEBUG, default=logging.INFO)
     opts.add_option('-V', '--wrapperVerbose', action='store_true', default=False)
        
     oArgs, pArgs = opts.parse_args()
-    if len(pArgs) != 1:
-        # Eventually change to allow multiple task files, with some sort of indication of which file a task comes from.
-        print >>sys.stderr, 'Need one (and only one) task file.'
+    if oArgs.prefetch < 1 or oArgs.wsPoolSize < 1:
+        print >>sys.stderr, 'prefetch and wsPoolSize must be at least 1.'
+        sys.exit(1)
+    if oArgs.retries < 0 or oArgs.retryDelay < 0:
+        print >>sys.stderr, 'retries and retryDelay may not be negative.'
+        sys.exit(1)
+    if oArgs.local < 0:
+        print >>sys.stderr, 'local may not be negative.'
+        sys.exit(1)
+    if oArgs.nodeMem:
+        try:
+            memMB(oArgs.nodeMem)
+        except ValueError:
+            print >>sys.stderr, 'Bad nodeMem: %s'%oArgs.nodeMem
+            sys.exit(1)
+    specs = []
+    for arg in pArgs:
+        m = re.match(r'(.*)@(-?\d+)$', arg)
+        if m and not os.path.exists(arg):
+            specs.append((m.group(1), int(m.group(2))))
+        else:
+            specs.append((arg, 0))
+    if not specs:
+        print >>sys.stderr, 'Need at least one task file.'
         opts.print_help(sys.stderr)
         sys.exit(1)
+    for spec, priority in specs:
+        if not isStreamed(spec) and not os.path.isfile(spec):
+            print >>sys.stderr, 'Task file %s does not exist or is not a regular file.'%spec
+            sys.exit(1)
+    bases = [outputBase(spec) for spec, priority in specs]
+    if len(set(bases)) != len(bases):
+        print >>sys.stderr, 'Each task file may only be given once.'
+        sys.exit(1)
 
     setupLogging(oArgs.verbose, oArgs.logFile)
-    if oArgs.pnwss:
-        if nwssSet: LogW('pnwss overrides nwssHost and nwssPort.')
-        pnwss = pnwsst.NwsLocalServer(logFile=oArgs.logFile+'.pnwss')
-        LogI('Started personal networkspace server: %s %d %d'%(pnwss.host, pnwss.port, pnwss.webport))
-        setattr(oArgs, 'nwssHost', pnwss.host)
-        setattr(oArgs, 'nwssPort', pnwss.port)
+    if oArgs.local:
+        # the driver runs the tasks itself, so there are no wrappers to talk to.
+        if oArgs.transport != 'nws' or oArgs.nodeAgents: LogW('local runs the tasks in the driver; ignoring transport and nodeAgents.')
+        oArgs.transport, oArgs.nodeAgents = 'local', False
+    if oArgs.transport == 'nws':
+        # only needed (along with Twisted, for pnwss) with this transport.
+        import nws.client, pnwsst
+        if oArgs.pnwss:
+            if nwssSet: LogW('pnwss overrides nwssHost and nwssPort.')
+            pnwss = pnwsst.NwsLocalServer(logFile=oArgs.logFile+'.pnwss')
+            LogI('Started personal networkspace server: %s %d %d'%(pnwss.host, pnwss.port, pnwss.webport))
+            setattr(oArgs, 'nwssHost', pnwss.host)
+            setattr(oArgs, 'nwssPort', pnwss.port)
+    elif oArgs.pnwss or nwssSet:
+        LogW('The %s transport does not use an nws server; ignoring pnwss, nwssHost and nwssPort.'%oArgs.transport)
 
     LogI('Control process is %d.'%os.getpid())
-    LogI('sqDedicated run started using nws server %s %d'%(oArgs.nwssHost, oArgs.nwssPort))
+    if oArgs.packResources and oArgs.speculate:
+        # a copy would need cores of its own.
+        LogW('speculate does not work with packResources; ignoring it.')
+        oArgs.speculate = False
+    if oArgs.packResources and oArgs.prefetch > 1:
+        # a task queued behind another on an engine would hold cores it isn't using.
+        LogW('packResources places tasks one at a time; ignoring prefetch.')
+        oArgs.prefetch = 1
+    LogI('Engines prefetch up to %d task(s).'%oArgs.prefetch)
     
     key=('SENTINEL %s %s %s' % (os.environ['LOGNAME'], time.asctime(), pArgs[0])).replace(' ', '_')
     LogI('Sentinel key: %s' % key)
 
-    ws = nws.client.NetWorkSpace(key, serverHost=oArgs.nwssHost, serverPort=oArgs.nwssPort)
-    ws.store('Launched', '0')
-    ws.store('Done', '0')
-    ws.store('Failed', '0')
-    ws.store('Succeeded', '0')
+    history = None
+    if oArgs.longestFirst:
+        # read before the STATUS files are started afresh.
+        history = History([outputBase(spec)+'.STATUS' for spec, priority in specs] + [f for f in oArgs.history.split(',') if f])
+        if not history.count: LogW('longestFirst: no runtime history found, so tasks run in file order.')
+    streams = TaskStreams(specs, oArgs.resume, oArgs.packResources, history)
 
-    # needed to synchronize access by threads running tasks.
-    wsSem = threading.Lock()
+    deadline = None
+    if oArgs.deadline:
+        # runtimes so far come from the longestFirst history, if any.
+        deadline = Deadline(oArgs.deadline, history or History([]))
+        LogI('Deadline: %s, so stopping by %s.'%(time.ctime(deadline.end), time.ctime(deadline.cutoff)))
+    if len(specs) > 1: LogI('Task files (priority): %s'%', '.join(['%s (%d)'%spec for spec in specs]))
 
+    metrics = Metrics()
+    progress = Progress()
     logFilePath = os.path.dirname(os.path.realpath(oArgs.logFile)) # all other log files are placed in the same directory as the main log file.
+    if oArgs.transport == 'local':
+        transport = LocalTransport(oArgs.local, logFilePath)
+        LogI('sqDedicated run started with %d local slot(s).'%oArgs.local)
+    elif oArgs.transport == 'nws':
+        LogI('sqDedicated run started using nws server %s %d'%(oArgs.nwssHost, oArgs.nwssPort))
+        transport = NwsTransport(key, oArgs.nwssHost, oArgs.nwssPort, oArgs.wsPoolSize)
+        transport.publish(progress.snapshot(), wait=True)
+    else:
+        transport = NativeTransport(key)
+        LogI('sqDedicated run started using the native transport on %s %d'%(transport.host, transport.port))
 
-    cmdv = launchcmd() + \
-            [sys.executable, WRAPPER, str(oArgs.wrapperVerbose),
-            logFilePath, key, oArgs.nwssHost, str(oArgs.nwssPort)]
-    LogI('Launching workers with command: ' + ' '.join(cmdv))
-    launcherp = subprocess.Popen(cmdv,
-            stdout=open('%s/launcher.out'%logFilePath, 'w'),
-            stderr=open('%s/launcher.err'%logFilePath, 'w'))
+    pt = threading.Thread(None, progress.publisher)
+    pt.setDaemon(True)
+    pt.start()
 
-    LogI('launcher pid: %d' % launcherp.pid)
+    metrics.f = open(os.path.join(logFilePath, 'metrics.jsonl'), 'w')
+    mt = threading.Thread(None, metrics.writer)
+    mt.setDaemon(True)
+    mt.start()
 
-    # launcher command will launch the engines, collect info from them.
-    ep = EnginePool(ws)
+    jt = threading.Thread(None, streams.syncer)
+    jt.setDaemon(True)
+    jt.start()
+
+    if oArgs.telemetry > 0:
+        tt = threading.Thread(None, collectTelemetry, args=(os.path.join(logFilePath, 'telemetry.tsv'),))
+        tt.setDaemon(True)
+        tt.start()
+        if oArgs.local:
+            tst = threading.Thread(None, transport.sample, args=(oArgs.telemetry,))
+            tst.setDaemon(True)
+            tst.start()
+
+    if not oArgs.local:
+        cmdv = launchcmd() + [sys.executable, WRAPPER]
+        if oArgs.transport != 'nws': cmdv += ['--transport=%s'%oArgs.transport]
+        if oArgs.telemetry > 0: cmdv += ['--telemetry=%g'%oArgs.telemetry]
+        if oArgs.nodeAgents:
+            # agents pick their slot count out of this by SLURM_NODEID.
+            os.environ['SQ_SLOTS_PER_NODE'] = ','.join(map(str, slurmCounts(os.getenv('SLURM_TASKS_PER_NODE'))))
+            cmdv += ['--agent']
+        cmdv += [str(oArgs.wrapperVerbose), logFilePath] + transport.wrapperArgs()
+        LogI('Launching workers with command: ' + ' '.join(cmdv))
+        launcherp = subprocess.Popen(cmdv,
+                stdout=open('%s/launcher.out'%logFilePath, 'w'),
+                stderr=open('%s/launcher.err'%logFilePath, 'w'))
 
+        LogI('launcher pid: %d' % launcherp.pid)
 
-    tStream = TaskStream(pArgs[0])
+    pacer = LaunchPacer(LaunchDelay, LatencyTarget)
 
-    taskStatus = open(tStream.taskFileName+'.STATUS', 'w', 0)
-    taskRogues = open(tStream.taskFileName+'.ROGUES', 'w', 0)
+    # launcher command will launch the engines, collect info from them.
+    ep = EnginePool(transport, oArgs.prefetch, oArgs.packResources)
+
+    ct = threading.Thread(None, collectCompletions, args=(ep, streams))
+    ct.setDaemon(True)
+    ct.start()
 
     goodbye = False
 
+    if oArgs.statusPort >= 0:
+        try:
+            server = BaseHTTPServer.HTTPServer(('', oArgs.statusPort), StatusHandler)
+        except socket.error, e:
+            LogW('Could not start the status server: %s'%e)
+        else:
+            st = threading.Thread(None, server.serve_forever)
+            st.setDaemon(True)
+            st.start()
+            statusHost = socket.gethostname()
+            open(os.path.join(logFilePath, 'status.address'), 'w').write('%s %d\n'%(statusHost, server.server_port))
+            LogI('Status server at http://%s:%d/status'%(statusHost, server.server_port))
+
     def runThread():
-        runTasks(ep, tStream, key)
+        runTasks(ep, streams, key)
         LogI('runTasks has finished.')
-        taskRogues.close()
-        taskStatus.close()
+        transport.publish(progress.snapshot(), wait=True)
+        LogI('Final progress: %s (%d publishes).'%(', '.join(['%s %d'%(n, progress.counts[n]) for n in Progress.names]), progress.publishes))
+        streams.close()
         
-        tStream.dumpRemaining()
+        streams.dumpRemaining()
+        metrics.write()
         LogI('Run completed.')
-        pnwss.stop()
+        transport.stop()
+        # local samples end with the run, so let the last of them be written.
+        if oArgs.local and oArgs.telemetry > 0: tt.join(5)
         global goodbye
         goodbye = True
         os.kill(os.getpid(), signal.SIGTERM)
@@ -368,6 +2499,15 @@ if '__main__' == __name__:
     rt = threading.Thread(None, runThread)
     rt.start()
 
+    if deadline:
+        # the last resort: whatever is still running at the deadline is stopped, as for a signal.
+        def deadlineReached():
+            LogW('Deadline reached: stopping.')
+            os.kill(os.getpid(), signal.SIGTERM)
+        dt = threading.Timer(max(deadline.cutoff - time.time(), 0), deadlineReached)
+        dt.setDaemon(True)
+        dt.start()
+
     def noteSignal(sig, frame):
         LogI('Ignoring signal %d.'%sig)
         
@@ -384,9 +2524,10 @@ if '__main__' == __name__:
         else:
             LogI('Received signal %d. Shutting down.'%sig)
 
-        tStream.dumpInflight()
+        streams.dumpInflight()
 
         ep.shutdown()
+        streams.interrupt()
         
     sigs = [ 1, 2, 3, 15 ]
     for x in sigs:
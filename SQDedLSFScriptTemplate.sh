@@ -7,6 +7,7 @@
 #BSUB -M %(mem)s
 #BSUB -oo LSF_%(title)s_out.txt
 
+SQSTART=$(date +%%s)
 %(modload)s
 SQDIR="%(logdir)s"
 mkdir "$SQDIR"
@@ -27,7 +28,7 @@ else
 fi
 "$PYTHON_BIN/python" "%(sqScript)s" \
   --logFile="$SQDIR/SQ.log" \
-  --maxTasksPerNode=%(mtpn)s --pnwss --wrapperVerbose \
+  --maxTasksPerNode=%(mtpn)s --prefetch=%(prefetch)d%(deadlineopt)s --pnwss --wrapperVerbose \
   "%(jobFile)s"
 RETURNCODE=$?
 echo "$(date +'%%F %%T') Writing exited file."
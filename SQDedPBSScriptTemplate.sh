@@ -4,6 +4,7 @@
 #PBS -o PBS_%(title)s_out.txt
 #PBS -j oe
 
+SQSTART=$(date +%%s)
 cd "$PBS_O_WORKDIR"
 %(modload)s
 SQDIR="%(logdir)s"
@@ -25,7 +26,7 @@ else
 fi
 "$PYTHON_BIN/python" "%(sqScript)s" \
   --logFile="$SQDIR/SQ.log" \
-  --maxTasksPerNode=%(mtpn)s --pnwss --wrapperVerbose \
+  --maxTasksPerNode=%(mtpn)s --prefetch=%(prefetch)d%(deadlineopt)s --pnwss --wrapperVerbose \
   "%(jobFile)s"
 RETURNCODE=$?
 echo "$(date +'%%F %%T') Writing exited file."
@@ -8,6 +8,7 @@
 #SBATCH -o SBATCH_%(title)s_out.txt
 #SBATCH -e SBATCH_%(title)s_err.txt
 
+SQSTART=$(date +%%s)
 %(modload)s
 
 SQDIR="%(logdir)s"
@@ -18,7 +19,7 @@ echo "$(date +'%%F %%T') About to execute %(sqScript)s using task file: %(jobFil
 
 python "%(sqScript)s" \
   --logFile="$SQDIR/SQ.log" \
-  --pnwss --wrapperVerbose \
+  --prefetch=%(prefetch)d%(agentopt)s%(transportopt)s%(resumeopt)s%(longestopt)s%(speculateopt)s%(retryopt)s%(telemetryopt)s%(statusopt)s%(deadlineopt)s --wrapperVerbose \
   "%(jobFile)s"
 RETURNCODE=$?
 echo "$(date +'%%F %%T') Writing exited file."
@@ -1,15 +1,31 @@
 #!/usr/bin/env python
 # Set the above path as part of the install?
 
-import logging, nws.client, os, signal, socket, subprocess, sys, time
+import logging, optparse, os, signal, socket, sqrunner, sqtelemetry, sqtransport, sys, time
 LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
 
 myHost = socket.gethostname()
 
-prog, verbose, logFilePath, key, nwssHost, nwssPort = sys.argv
+opts = optparse.OptionParser(usage='usage: %prog [options] Verbose LogFilePath Key Host Port')
+opts.add_option('--agent', help='Run as the node agent: one wrapper running several tasks at once.', action='store_true', default=False)
+opts.add_option('--telemetry', help='Sample this node\'s load, memory and i/o every this many seconds, and send them to the driver (0: don\'t).', metavar='Seconds', type='float', default=0)
+opts.add_option('--transport', help='How to talk to the driver (see SQDedDriver.py).', type='choice', choices=['nws', 'native'], default='nws')
+oArgs, pArgs = opts.parse_args()
+verbose, logFilePath, key, nwssHost, nwssPort = pArgs
 
 engineNum = os.getenv('SLURM_PROCID')
 
+def agentSlots():
+    # the driver passes on how many tasks Slurm allotted to each node.
+    perNode = os.getenv('SQ_SLOTS_PER_NODE')
+    if perNode and os.getenv('SLURM_NODEID'):
+        return int(perNode.split(',')[int(os.getenv('SLURM_NODEID'))])
+    return int(os.getenv('SLURM_CPUS_ON_NODE', '1'))
+
+# shared by all wrappers, see SQDedDriver.py.
+CompletionVar = 'task status'
+TelemetryVar = 'telemetry'
+
 outbase = '%s/%s_%s'%(logFilePath, myHost, engineNum)
 
 sys.stderr = open('%s.err'%outbase, 'w', 0)
@@ -27,93 +43,262 @@ for x in sigs:
 
 LogI('Wrapper script running on %s (pid: %d, %s).'%(myHost, os.getpid(), engineNum))
 
-ws = nws.client.NetWorkSpace(key, serverHost=nwssHost, serverPort=int(nwssPort))
-
-LogI('Opened workspace %s on %s at %s.'%(key, nwssHost, nwssPort))
-
-# register with the driver.
-ws.store('engine info', (myHost, engineNum))
-
+from collections import deque
+from threading import Condition, Lock, Thread
+
+# only needed with this transport.
+if oArgs.transport == 'nws': import nws.client
+
+class NwsLink:
+    # the wrapper's end of the nws transport, with the same methods as
+    # sqtransport.NativeClient.
+    def __init__(self, key, host, port):
+        self.key, self.host, self.port = key, host, port
+        self.ws = nws.client.NetWorkSpace(key, serverHost=host, serverPort=port)
+        self.rtws, self.rtwsSem = None, Lock()
+
+    def register(self, host, engine, slots=0):
+        if slots:
+            self.ws.store('engine info', (host, engine, slots))
+        else:
+            self.ws.store('engine info', (host, engine))
+        reply = self.ws.fetch('engine %s status'%engine)
+        if reply.startswith('OK'):
+            # separate connection to be used by the run task threads.
+            # with the fetch in nextBatch blocking on ws, completions
+            # can't go out on it, so an agent sends all its slots'
+            # completions through this one.
+            self.rtws = nws.client.NetWorkSpace(self.key, serverHost=self.host, serverPort=self.port)
+        return reply
+
+    def nextBatch(self):
+        # a single task arrives as a tuple, a chunk of them as a list.
+        # (-2, index) is a request to stop a task.
+        batch = self.ws.fetch('engine %s task'%engineNum)
+        if not isinstance(batch, list): batch = [batch]
+        return batch
+
+    def sendStatus(self, i, status, startTime, stopTime, rogue, pid, usage=None):
+        st = (i, status, startTime, stopTime, rogue, pid, myHost, engineNum)
+        if usage: st += (usage,)
+        self.rtwsSem.acquire()
+        try:
+            self.rtws.store(CompletionVar, st)
+        finally:
+            self.rtwsSem.release()
+
+    def sendTelemetry(self, host, samples):
+        self.rtwsSem.acquire()
+        try:
+            self.rtws.store(TelemetryVar, (host, samples))
+        finally:
+            self.rtwsSem.release()
+
+if oArgs.transport == 'nws':
+    link = NwsLink(key, nwssHost, int(nwssPort))
+    LogI('Opened workspace %s on %s at %s.'%(key, nwssHost, nwssPort))
+else:
+    link = sqtransport.NativeClient(key, nwssHost, int(nwssPort))
+    LogI('Connected to the driver on %s at %s.'%(nwssHost, nwssPort))
+
+# register with the driver. an agent also says how many slots it has.
 # determine if this engine is needed (pbsdsh starts one eninge for
 # each core, so if the user restricts the max tasks per node, some
-# engines are not needed).
-if ws.fetch('engine %s status'%engineNum) != 'OK':
+# engines are not needed). the reply says how many tasks to run at
+# once, and whether this is the wrapper that samples the node.
+reply = link.register(myHost, engineNum, oArgs.agent and agentSlots() or 0).split()
+if reply[0] != 'OK':
     LogI('Wrapper script exiting (pid: %d, %s): I\'m not wanted.'%(os.getpid(), engineNum))
     sys.exit(0)
+slots = int((reply + ['1'])[1])
+sampler = 'sample' in reply[2:]
+LogI('Running %d task(s) at a time.'%slots)
+
+class Telemetry(Thread):
+    # samples the node every interval seconds; they go to the driver in
+    # batches of sqtelemetry.Batch.
+    def __init__(self, interval):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+        self.samples, self.sem = [], Lock()
+        self.sampler = sqtelemetry.Sampler()
 
-# separate connection to be used by the run task thread.
-rtws = nws.client.NetWorkSpace(key, serverHost=nwssHost, serverPort=int(nwssPort))
-
-from threading import Thread
+    def run(self):
+        while 1:
+            try:
+                s = self.sampler.sample()
+            except Exception, e:
+                LogW('Telemetry sampling failed, so stopping it: %s'%e)
+                return
+            if s:
+                self.sem.acquire()
+                self.samples.append(s)
+                full = len(self.samples) >= sqtelemetry.Batch
+                self.sem.release()
+                if full: self.flush()
+            time.sleep(self.interval)
+
+    def flush(self):
+        self.sem.acquire()
+        samples, self.samples = self.samples, []
+        self.sem.release()
+        if not samples: return
+        try:
+            link.sendTelemetry(myHost, samples)
+        except Exception, e:
+            LogI('Could not send telemetry: %s'%e)
 
 class RunTask(Thread):
-    def __init__(self, i, cmd):
+    def __init__(self, i, cmd, outbase):
         Thread.__init__(self)
         self.i, self.cmd, self.pid = i, cmd, None
+        self.outbase = outbase
 
     def run(self):
-        errf = open('%s_uc.err'%outbase, 'a')
-        errf.seek(0, 2)
-        outf = open('%s_uc.out'%outbase, 'a')
-        outf.seek(0, 2)
-        open('%s_split'%outbase, 'a').write('%d %d %d: %s\n'%(self.i, errf.tell(), outf.tell(), repr(self.cmd)))
-
-        startTime = time.time()
-
-        p = subprocess.Popen(['/bin/bash', '-c', self.cmd], stdout=outf, stderr=errf)
+        # in a process group of its own, so that all of it can be killed (see killTask).
+        p, startTime = sqrunner.startTask(self.i, self.cmd, self.outbase)
         self.pid = p.pid
 
-        # TODO: when should these files be closed?
-
         LogI('Task %d: child %d started at %f'%(self.i, p.pid,  startTime))
 
-        p.wait()
+        usage = sqrunner.waitTask(p)[1]
         self.pid = None
 
         LogI('Task %d: pid %d returned %d.'%(self.i, p.pid, p.returncode))
 
-        # we need a new connection to avoid stomping on the existing one.
-        rtws.store('Task %d Status'%self.i, (p.returncode, startTime, time.time(), 0, p.pid, myHost, engineNum))
+        link.sendStatus(self.i, p.returncode, startTime, time.time(), 0, p.pid, usage)
+
+# tasks the driver has sent ahead (see SQDedDriver.py --prefetch) wait
+# here until a runner gets to them. there is one runner per slot.
+pending = deque()
+pendingCV = Condition()
+stopping = False
 
+class TaskRunner(Thread):
+    def __init__(self, outbase):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.current = None
+        self.outbase = outbase
+
+    def run(self):
+        while 1:
+            pendingCV.acquire()
+            while not pending and not stopping: pendingCV.wait()
+            if stopping:
+                pendingCV.release()
+                break
+            i, task = pending.popleft()
+            self.current = RunTask(i, task, self.outbase)
+            self.current.start()
+            pendingCV.release()
+            self.current.join()
+
+def killGroup(pid, sig):
+    # a task runs in a process group of its own (see sqrunner.py), so
+    # that whatever it started goes too.
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        try: os.kill(pid, sig)
+        except OSError: pass
+
+def killTask(j):
+    # the driver has no more use for task j (another copy of it finished
+    # first): drop it if it hasn't started, or kill it if it has.
+    pendingCV.acquire()
+    dropped = [t for t in pending if t[0] == j]
+    for t in dropped: pending.remove(t)
+    running = [runner.current for runner in runners if runner.current and runner.current.i == j and runner.current.pid]
+    pendingCV.release()
+    for t in dropped:
+        LogI('Task %d: dropped before starting.'%j)
+        link.sendStatus(j, None, -1.0, -1.0, 0, 0)
+    for rtt in running:
+        pid = rtt.pid
+        if not pid: continue
+        LogI('Task %d: killing pid %d, as asked.'%(j, pid))
+        killGroup(pid, 9)
+
+# an agent's slots each get their own output files.
+if oArgs.agent:
+    runners = [TaskRunner('%s.%d'%(outbase, x)) for x in xrange(slots)]
+else:
+    runners = [TaskRunner(outbase)]
+for runner in runners: runner.start()
+
+# one wrapper on each node samples it: the first one the driver took there.
+telemetry = None
+if oArgs.telemetry > 0 and sampler:
+    try:
+        telemetry = Telemetry(oArgs.telemetry)
+        telemetry.start()
+        LogI('Sampling this node every %gs.'%oArgs.telemetry)
+    except Exception, e:
+        LogW('Not sampling this node: %s'%e)
 
 taskCount = 0
 engineTag = 'engine %s task'%engineNum
-rtt = None
 while 1:
     try:
-        i, task = ws.fetch(engineTag)
+        batch = link.nextBatch()
     except:
         break
 
-    LogI('Fetched task %d: %s'%(i, task))
-
-    if -1 == i and 'bye' == task: break
-
-    taskCount += 1
-
-    rtt = RunTask(i, task)
-    rtt.start()
-
-if rtt and rtt.is_alive():
+    if (-1, 'bye') in batch: break
+
+    for i, task in batch:
+        if i == -2: killTask(task)
+    batch = [t for t in batch if t[0] != -2]
+
+    pendingCV.acquire()
+    for i, task in batch:
+        LogI('Fetched task %d: %s'%(i, task))
+        pending.append((i, task))
+    taskCount += len(batch)
+    pendingCV.notifyAll()
+    pendingCV.release()
+
+# whatever samples are left go out with the last completions.
+if telemetry: telemetry.flush()
+
+pendingCV.acquire()
+stopping = True
+unstarted = list(pending)
+pending.clear()
+running = [runner.current for runner in runners if runner.current and runner.current.is_alive()]
+pendingCV.notifyAll()
+pendingCV.release()
+
+# let the driver know which of the tasks it sent us were never started.
+for i, task in unstarted:
+    LogI('Task %d: never started.'%i)
+    link.sendStatus(i, None, -1.0, -1.0, 0, 0)
+
+for rtt in running:
     try:
         if rtt.pid:
             try:
                 LogI('Task %d: pid %d is being tickled.'%(rtt.i, rtt.pid))
-                os.kill(rtt.pid, 5)
+                killGroup(rtt.pid, 5)
             except:
                 pass
-        rtt.join(3) # wait a bit for the thread.
+    except:
+        pass
+
+deadline = time.time() + 3
+for rtt in running:
+    try:
+        rtt.join(max(deadline - time.time(), 0)) # wait a bit for the thread.
         if rtt.is_alive() and rtt.pid:
-            try: 
-                os.kill(rtt.pid, 9)
-            except:
-                pass
+            killGroup(rtt.pid, 9)
             LogI('Task %d: pid %d is being whacked and dummy status generated.'%(rtt.i, rtt.pid))
-            ws.store('Task %d Status'%rtt.i, (-1, -1.0, -1.0, 1, rtt.pid, myHost, engineNum))
+            link.sendStatus(rtt.i, -1, -1.0, -1.0, 1, rtt.pid)
 
     except:
         pass # assume that this means the thread exited on its own.
 
-LogI('Wrapper script exiting on %s (pid: %d, %s), "%s" after %d tasks.'%(myHost, os.getpid(), engineNum, engineTag, taskCount))
+LogI('Wrapper script exiting on %s (pid: %d, %s), "%s" after %d tasks (%d never started).'%(myHost, os.getpid(), engineNum, engineTag, taskCount, len(unstarted)))
 
 sys.exit(0)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# args [options]
+import itertools, json, optparse, os, shutil, subprocess, sys, tempfile, time
+
+opts = optparse.OptionParser(usage='''%prog OPTIONS
+
+Measure the driver's throughput on this host alone. For each transport,
+engine count and task count given, the real SQDedDriver.py and
+SQDedWrapper.py are run through sqLocalLaunch.py (in place of srun) on
+a task file of no-op tasks (or of sleeps, with --sleep). For each run,
+a line gives the tasks per second (from the first task's start to the
+last one's end, according to STATUS), the driver's dispatch latency
+and the tasks' start lag (from being sent to starting) at the 50th,
+90th and 99th percentiles (from metrics.jsonl), and the cpu time the
+driver process used, in all and per task.
+
+Compare the figures from the same host before and after a change. With
+many engines on few cores, the engines compete with the driver, so
+look for changes rather than at absolute values.''')
+
+opts.add_option('-e', '--engines', dest='engines', default='1,4,16',
+  help='Comma separated engine counts. Defaults to %default.')
+opts.add_option('-n', '--tasks', dest='tasks', default='1000,10000',
+  help='Comma separated task counts. Defaults to %default.')
+opts.add_option('-s', '--sleep', type='float', dest='sleep', default=0,
+  help='Seconds each task sleeps. Defaults to %default (tasks do nothing).')
+opts.add_option('-t', '--transport', dest='transport', default='native',
+  help='Comma separated transports (nws, native). nws needs nws and Twisted. '
+       'Defaults to %default.')
+opts.add_option('-d', '--driverArgs', dest='driverArgs', default='',
+  help='More options for the driver, e.g. "--prefetch=4 --nodeAgents".')
+opts.add_option('-o', '--output', dest='output', default=None,
+  help='Append each run\'s figures to this file as a line of JSON. Not required.')
+opts.add_option('-w', '--workdir', dest='workdir', default=None,
+  help='Directory for task files and logs, which is kept. Defaults to a '
+       'temporary one, removed at the end.')
+opts.add_option('--timeout', type='float', dest='timeout', default=600,
+  help='Seconds to let a run take before it is stopped. Defaults to %default.')
+
+oArgs, pArgs = opts.parse_args()
+if pArgs:
+    opts.print_help(sys.stderr)
+    sys.exit(1)
+
+# We assume that related scripts live in the same directory as this script.
+myDir = os.path.dirname(os.path.realpath(__file__))+os.path.sep
+driver = myDir + 'SQDedDriver.py'
+launcher = myDir + 'sqLocalLaunch.py'
+
+def taskFile(workdir, ntasks):
+    fileName = os.path.join(workdir, 'bench_%d.tasks' % ntasks)
+    if not os.path.exists(fileName):
+        task = oArgs.sleep > 0 and 'sleep %g\n' % oArgs.sleep or 'true\n'
+        f = open(fileName, 'w')
+        f.write(task * ntasks)
+        f.close()
+    return fileName
+
+def statusSpan(fileName):
+    # (tasks, succeeded, first start, last stop) from a STATUS file.
+    n, ok, first, last = 0, 0, None, None
+    for l in open(fileName):
+        w = l.split('\t')
+        if len(w) < 7: continue
+        n += 1
+        if w[1] == '(0, 0)': ok += 1
+        start, stop = float(w[2]), float(w[3])
+        if start >= 0 and (first == None or start < first): first = start
+        if stop >= 0 and (last == None or stop > last): last = stop
+    return n, ok, first, last
+
+def lastMetrics(fileName):
+    m = {}
+    try:
+        for l in open(fileName):
+            if l.strip(): m = json.loads(l)['metrics']
+    except (IOError, ValueError):
+        pass
+    return m
+
+def run(workdir, transport, engines, ntasks):
+    tf = taskFile(workdir, ntasks)
+    logdir = os.path.join(workdir, 'run_%s_%d_%d' % (transport, engines, ntasks))
+    if os.path.exists(logdir): shutil.rmtree(logdir)
+    os.mkdir(logdir)
+    env = dict(os.environ)
+    env.update({'SQ_LAUNCHER': '"%s" "%s"' % (sys.executable, launcher),
+                'SLURM_NTASKS': str(engines), 'SLURM_JOB_NUM_NODES': '1',
+                'SLURM_TASKS_PER_NODE': str(engines), 'SQMetricsInterval': '0'})
+    env.setdefault('LOGNAME', 'sqbench')
+    cmd = [sys.executable, driver, '--logFile=%s' % os.path.join(logdir, 'SQ.log'), '--transport=%s' % transport, '--statusPort=-1']
+    if transport == 'nws': cmd.append('--pnwss')
+    cmd += oArgs.driverArgs.split() + [tf]
+    out = open(os.path.join(logdir, 'driver.out'), 'w')
+    t0 = time.time()
+    p = subprocess.Popen(cmd, env=env, stdout=out, stderr=subprocess.STDOUT, cwd=workdir)
+    deadline = t0 + oArgs.timeout
+    while 1:
+        pid, status, ru = os.wait4(p.pid, os.WNOHANG)
+        if pid: break
+        if time.time() > deadline:
+            sys.stderr.write('Run %s took more than %gs: stopping it.\n' % (logdir, oArgs.timeout))
+            os.kill(p.pid, 15)
+            deadline = time.time() + 30
+        time.sleep(.05)
+    wall = time.time() - t0
+    out.close()
+
+    n, ok, first, last = statusSpan(tf + '.STATUS')
+    span = first != None and last != None and max(last - first, 1e-6) or 0
+    m = lastMetrics(os.path.join(logdir, 'metrics.jsonl'))
+    pct = lambda name: [1000*m.get(name, {}).get(q, 0) for q in ('p50', 'p90', 'p99')]
+    cpu = ru.ru_utime + ru.ru_stime
+    return {'transport': transport, 'engines': engines, 'tasks': ntasks, 'sleep': oArgs.sleep,
+            'driverArgs': oArgs.driverArgs, 'time': t0, 'exit': status >> 8,
+            'completed': n, 'succeeded': ok, 'wall': wall, 'span': span,
+            'tasksPerSec': span and n / span or 0,
+            'dispatchMs': pct('dispatch'), 'startLagMs': pct('startLag'),
+            'driverCpu': cpu, 'cpuMsPerTask': 1000 * cpu / max(n, 1)}
+
+workdir = oArgs.workdir
+if workdir:
+    if not os.path.isdir(workdir): os.makedirs(workdir)
+else:
+    workdir = tempfile.mkdtemp(prefix='sqbench.')
+workdir = os.path.abspath(workdir)
+
+try:
+    transports = oArgs.transport.split(',')
+    engineCounts = [int(e) for e in oArgs.engines.split(',')]
+    taskCounts = [int(n) for n in oArgs.tasks.split(',')]
+except ValueError, e:
+    sys.stderr.write('Error: %s\n' % e)
+    sys.exit(1)
+
+print('%-9s %7s %8s %8s %9s %22s %22s %8s %8s' % ('transport', 'engines', 'tasks', 'wall(s)', 'tasks/s',
+      'dispatch ms p50/90/99', 'start lag ms p50/90/99', 'cpu(s)', 'ms/task'))
+try:
+    for transport, engines, ntasks in itertools.product(transports, engineCounts, taskCounts):
+        r = run(workdir, transport, engines, ntasks)
+        note = ''
+        if r['exit'] or r['completed'] != ntasks or r['succeeded'] != ntasks:
+            note = '  (exit %d, %d of %d succeeded: see %s)' % (r['exit'], r['succeeded'], ntasks, workdir)
+        print('%-9s %7d %8d %8.1f %9.1f %22s %22s %8.2f %8.3f%s' % (transport, engines, ntasks, r['wall'], r['tasksPerSec'],
+              '%.2f/%.2f/%.2f' % tuple(r['dispatchMs']), '%.2f/%.2f/%.2f' % tuple(r['startLagMs']),
+              r['driverCpu'], r['cpuMsPerTask'], note))
+        sys.stdout.flush()
+        if oArgs.output:
+            f = open(oArgs.output, 'a')
+            f.write(json.dumps(r, sort_keys=True) + '\n')
+            f.close()
+finally:
+    if not oArgs.workdir: shutil.rmtree(workdir, True)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 # args TaskFile
-import optparse, os, sys
+import optparse, os, sqtaskfile, sys
 
 NORMAL_WALLTIME = 24 * 60
 
@@ -76,6 +76,9 @@ opts.add_option('-J', '--name', dest='name', default='SimpleQueue',
   help='Base job name to use. Not required. Defaults to %default.')
 opts.add_option('--logdir', dest='logdir', default='SQ_Files_${LSB_JOBID}',
   help='Base job name to use. Not required. Defaults to %default.')
+opts.add_option('-k', '--prefetch', type='int', dest='prefetch', default=1,
+  help='Number of tasks each worker holds at once, one running and the rest '
+       'queued locally. Not required. Defaults to %default.')
 
 oArgs, pArgs = opts.parse_args()
 if len(pArgs) != 1:
@@ -121,6 +124,11 @@ if oArgs.tpn:
 else:
     mtpn = 1000000
 
+prefetch = max(1, oArgs.prefetch)
+
+# the driver stops starting tasks that won't finish within the walltime.
+deadlineopt = ' --deadline=$((SQSTART + %d))' % (gettime(walltime) * 60)
+
 if oArgs.ptile:
     spanspec = "ptile=%d" % oArgs.ptile
 else:
@@ -136,8 +144,8 @@ sq_python_path = os.getenv('SQ_PYTHON_PATH', '')
 # Issue a warning if the task file doesn't exist, or if they've
 # specified more processors than makes sense for the number of tasks
 # in the task file.
-if os.path.exists(jobFile):
-    ntasks = len([x for x in open(jobFile).readlines() if x.strip() and x.strip()[0] != '#'])
+if os.path.isfile(jobFile):
+    ntasks = sqtaskfile.TaskFile(jobFile).ntasks
     if procs > ntasks:
         sys.stderr.write('Warning: %s contains %d tasks, which warrants '
                          'at most %d processors, but you requested '
@@ -147,6 +155,9 @@ if os.path.exists(jobFile):
         taskspercore = ntasks / float(procs)
         sys.stderr.write('Info: %s contains %d tasks\n' % (jobFile, ntasks))
         sys.stderr.write('Info: average tasks per core: %.1f\n' % taskspercore)
+elif os.path.exists(jobFile) or jobFile == '-' or jobFile.startswith('tcp:'):
+    # a named pipe, stdin or a port: tasks are streamed to the driver.
+    sys.stderr.write('Info: tasks will be read from %s as they arrive\n' % (jobFile,))
 else:
     sys.stderr.write('Warning: %s does not currently exist\n' % (jobFile,))
 
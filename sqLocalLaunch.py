@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# args [srun options] Command [Args]
+#
+# A stand-in for srun that starts every task on this host, for running
+# and benchmarking SimpleQueue without a cluster (see SQ_LAUNCHER in
+# the README, and sqBench.py). The command is started SLURM_NTASKS times
+# (or --ntasks), each copy with SLURM_PROCID and SLURM_LOCALID set to
+# its number and SLURM_NODEID to the fake node it is on: with
+# --ntasks-per-node=K, copies 0..K-1 are node 0, and so on; otherwise
+# all are node 0. The other srun options the driver passes are ignored.
+# Signals are passed on to the copies, and the exit status is the worst
+# of theirs.
+import os, signal, subprocess, sys
+
+ntasks = int(os.getenv('SLURM_NTASKS', '1'))
+perNode = 0
+args = sys.argv[1:]
+while args and args[0].startswith('-'):
+    opt = args.pop(0)
+    if opt in ('-n', '--ntasks') and args:
+        ntasks = int(args.pop(0))
+    elif opt.startswith('--ntasks='):
+        ntasks = int(opt.split('=', 1)[1])
+    elif opt.startswith('--ntasks-per-node='):
+        perNode = int(opt.split('=', 1)[1])
+if not args:
+    sys.stderr.write('usage: %s [srun options] Command [Args]\n' % sys.argv[0])
+    sys.exit(1)
+
+procs = []
+for k in xrange(ntasks):
+    env = dict(os.environ)
+    env['SLURM_PROCID'] = env['SLURM_LOCALID'] = str(k)
+    env['SLURM_NODEID'] = str(perNode and k / perNode or 0)
+    procs.append(subprocess.Popen(args, env=env))
+
+def passOn(sig, frame):
+    for p in procs:
+        try: os.kill(p.pid, sig)
+        except OSError: pass
+
+for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+    signal.signal(sig, passOn)
+
+rc = 0
+for p in procs:
+    while 1:
+        try:
+            status = p.wait()
+            break
+        except OSError:
+            # interrupted by a signal we passed on.
+            continue
+    if status < 0: status = 128 - status
+    rc = max(rc, status)
+sys.exit(rc)
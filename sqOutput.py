@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# args LogDir [Task ...]
+import mmap, multiprocessing, optparse, os, sqoutputs, sys
+
+opts = optparse.OptionParser(usage='''%prog OPTIONS LogDir [Task ...]
+
+Get the output of tasks run by SimpleQueue, from the output files the
+workers left in the logging directory LogDir. A task's standard output
+is written to standard output and its standard error to standard error.
+Tasks are numbered as in the first column of STATUS (with several task
+files, as numbered across them: task x of the s'th of n files is
+x*n + s-1). A task that was run more than once gives the output of its
+latest run.
+
+The first time, the workers' records of where each task's output
+starts are read and saved as an index, LogDir/output.IDX, which is used
+until the output changes, so that after that any task's output is found
+at once however many tasks there were.''')
+
+opts.add_option('-o', '--stdout', dest='which', action='store_const', const='out', default=None,
+  help='Only give standard output. Not required.')
+opts.add_option('-e', '--stderr', dest='which', action='store_const', const='err',
+  help='Only give standard error, to standard output. Not required.')
+opts.add_option('-l', '--list', dest='list', default=False, action='store_true',
+  help='List the index instead: for each task (or each one given), the times it ran, '
+       'the worker output files it is in, and the offset and length of its '
+       'standard output and standard error. Not required.')
+opts.add_option('-d', '--dump', dest='dump', default=None,
+  help='Write every task\'s output to <Task>.out and <Task>.err in this directory. Not required.')
+opts.add_option('-j', '--jobs', type='int', dest='jobs', default=0,
+  help='Processes to dump with, each taking the output files of some of the workers. '
+       'Defaults to the number of cpus.')
+
+def dumpFiles(args):
+    # one worker's output files: write out each of its tasks.
+    base, items, outdir = args
+    copied = 0
+    for which, suffix, col in (('out', '_uc.out', 0), ('err', '_uc.err', 2)):
+        data = ''
+        if os.path.exists(base + suffix):
+            f = open(base + suffix, 'rb')
+            if os.fstat(f.fileno()).st_size: data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+        for item in items:
+            i, off, n = item[0], item[1+col], item[2+col]
+            out = open(os.path.join(outdir, '%d.%s' % (i, which)), 'wb')
+            out.write(data[off:off+n])
+            out.close()
+            copied += n
+        if data: data.close()
+    return len(items), copied
+
+def dump(idx, outdir, jobs):
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+    groups = {}
+    for i in idx.tasks():
+        base, runs, outOff, outLen, errOff, errLen = idx.record(i)
+        groups.setdefault(base, []).append((i, outOff, outLen, errOff, errLen))
+    work = [(base, items, outdir) for base, items in groups.items()]
+    pool = multiprocessing.Pool(jobs or None)
+    try:
+        results = pool.map(dumpFiles, work, 1)
+    finally:
+        pool.close()
+        pool.join()
+    sys.stderr.write('Wrote the output of %d task(s), %d bytes, from %d worker file(s) to %s\n' % (
+        sum([r[0] for r in results]), sum([r[1] for r in results]), len(work), outdir))
+
+oArgs, pArgs = opts.parse_args()
+if not pArgs or (not pArgs[1:] and not oArgs.list and not oArgs.dump):
+    opts.print_help(sys.stderr)
+    sys.exit(1)
+
+logdir = pArgs[0]
+try:
+    tasks = [int(t) for t in pArgs[1:]]
+except ValueError, e:
+    sys.stderr.write('Error: tasks are given by number: %s\n' % e)
+    sys.exit(1)
+if not os.path.isdir(logdir):
+    sys.stderr.write('Error: %s is not a directory\n' % logdir)
+    sys.exit(1)
+
+idx = sqoutputs.OutputIndex(logdir)
+if not len(idx):
+    sys.stderr.write('Error: found no task output in %s\n' % logdir)
+    sys.exit(1)
+
+if oArgs.dump:
+    dump(idx, oArgs.dump, oArgs.jobs)
+    sys.exit(0)
+
+rc = 0
+if oArgs.list:
+    for i in tasks or idx.tasks():
+        r = idx.record(i)
+        if not r:
+            sys.stderr.write('Task %d: no output recorded\n' % i)
+            rc = 1
+            continue
+        base, runs, outOff, outLen, errOff, errLen = r
+        print('%d\t%d\t%s\t%d\t%d\t%d\t%d' % (i, runs, os.path.basename(base), outOff, outLen, errOff, errLen))
+    sys.exit(rc)
+
+for i in tasks:
+    if len(tasks) > 1:
+        sys.stdout.write('==> task %d <==\n' % i)
+        sys.stdout.flush()
+    if oArgs.which == 'err':
+        ok = idx.copy(i, 'err', sys.stdout)
+    else:
+        ok = idx.copy(i, 'out', sys.stdout)
+        if ok and not oArgs.which: idx.copy(i, 'err', sys.stderr)
+    if not ok:
+        sys.stderr.write('Task %d: no output recorded\n' % i)
+        rc = 1
+    sys.stdout.flush()
+sys.exit(rc)
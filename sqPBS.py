@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 # args TaskFile
-import optparse, os, sys
+import optparse, os, sqtaskfile, sys
 from math import ceil
 
 NORMAL_WALLTIME = 24 * 60 * 60
@@ -103,6 +103,9 @@ opts.add_option('--logdir', dest='logdir', default='SQ_Files_${PBS_JOBID}',
 opts.add_option('--useprocs', dest='useprocs', default=False,
   action='store_true',
   help='Should procs/tpn be used rather than nodes/ppn. Defaults to %default.')
+opts.add_option('-k', '--prefetch', type='int', dest='prefetch', default=1,
+  help='Number of tasks each worker holds at once, one running and the rest '
+       'queued locally. Not required. Defaults to %default.')
 
 oArgs, pArgs = opts.parse_args()
 if len(pArgs) != 1:
@@ -172,6 +175,14 @@ if oArgs.tpn:
 else:
     mtpn = ncpus
 
+prefetch = max(1, oArgs.prefetch)
+
+# the driver stops starting tasks that won't finish within the walltime.
+if oArgs.walltime and isinstance(gettime(oArgs.walltime), int):
+    deadlineopt = ' --deadline=$((SQSTART + %d))' % gettime(oArgs.walltime)
+else:
+    deadlineopt = ''
+
 if os.getenv('SQ_PYTHON'):
     pythoninterp = os.getenv('SQ_PYTHON')
 else:
@@ -182,8 +193,8 @@ sq_python_path = os.getenv('SQ_PYTHON_PATH', '')
 # Issue a warning if the task file doesn't exist, or if they've
 # specified more nodes than makes sense for the number of tasks
 # in the task file.
-if os.path.exists(jobFile):
-    ntasks = len([x for x in open(jobFile).readlines() if x.strip() and x.strip()[0] != '#'])
+if os.path.isfile(jobFile):
+    ntasks = sqtaskfile.TaskFile(jobFile).ntasks
     maxnodes = int(ceil(ntasks / float(mtpn)))
     if nodes > maxnodes:
         sys.stderr.write('Warning: %s contains %d tasks, which warrants '
@@ -196,6 +207,9 @@ if os.path.exists(jobFile):
         sys.stderr.write('Info: average tasks per core: %.1f\n' % taskspercore)
         if nodes > 1 and taskspercore < 1.0:
             sys.stderr.write('Info: you might consider using fewer nodes\n')
+elif os.path.exists(jobFile) or jobFile == '-' or jobFile.startswith('tcp:'):
+    # a named pipe, stdin or a port: tasks are streamed to the driver.
+    sys.stderr.write('Info: tasks will be read from %s as they arrive\n' % (jobFile,))
 else:
     sys.stderr.write('Warning: %s does not currently exist\n' % (jobFile,))
 
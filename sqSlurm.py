@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 # args TaskFile
-import optparse, os, sys
+import optparse, os, sqtaskfile, sys
 from math import ceil
 
 WALLTIME = 24 * 60 * 60
@@ -30,6 +30,21 @@ def gettime(s):
     except:
         return 'fas_very_long'
 
+def slurmtime(s):
+    # Slurm's time forms: M, M:S, H:M:S, D-H, D-H:M and D-H:M:S.
+    days, hms = 0, s
+    if '-' in s:
+        days, hms = s.split('-', 1)
+        days = int(days)
+        v = [int(i) for i in hms.split(':')]
+        v += [0]*(3 - len(v))
+    else:
+        v = [int(i) for i in hms.split(':')]
+        if len(v) == 1: v = v + [0]
+        v = [0]*(3 - len(v)) + v
+    h, m, sec = v
+    return ((days*24 + h)*60 + m)*60 + sec
+
 def defqueue(walltime):
     return "general"
 
@@ -74,6 +89,35 @@ opts.add_option('-N', '--name', dest='name', default='SimpleQueue',
   help='Base job name to use. Not required. Defaults to %default.')
 opts.add_option('--logdir', dest='logdir', default='SQ_Files_${SLURM_JOB_ID}',
   help='Name of logging directory. Defaults to %default.')
+opts.add_option('-k', '--prefetch', type='int', dest='prefetch', default=1,
+  help='Number of tasks each worker holds at once, one running and the rest '
+       'queued locally. Not required. Defaults to %default.')
+opts.add_option('-a', '--agents', dest='agents', default=False, action='store_true',
+  help='Run one node agent per node, which runs all the workers on that '
+       'node, rather than a separate process per worker. Not required.')
+opts.add_option('-t', '--transport', type='choice', choices=['nws', 'native'], dest='transport', default='nws',
+  help='How the driver and workers talk: through a personal nws server (nws), '
+       'or directly over sockets, without nws or Twisted (native). Defaults to %default.')
+opts.add_option('-r', '--resume', dest='resume', default=False, action='store_true',
+  help='Skip the tasks an earlier run of this task file completed, according '
+       'to its journal (<TaskFile>.JOURNAL). Not required.')
+opts.add_option('-L', '--longestFirst', dest='longestFirst', default=False, action='store_true',
+  help='Between DRAINs, run the tasks that took longest in the previous run '
+       '(according to <TaskFile>.STATUS) first. Not required.')
+opts.add_option('--retries', type='int', dest='retries', default=0,
+  help='Number of times to try a failed task again during the run, waiting '
+       'longer each time and, if possible, on a node it has not failed on. '
+       'Defaults to %default.')
+opts.add_option('--telemetry', type='float', dest='telemetry', default=0,
+  help='Sample each node\'s load, cpu, memory and i/o every this many seconds, '
+       'into telemetry.tsv in the logging directory. Defaults to %default (off).')
+opts.add_option('--statusPort', type='int', dest='statusPort', default=-1,
+  help='Serve the run\'s status over HTTP on this port (0: any free one), for '
+       'sq-status. Defaults to %default (no server).')
+opts.add_option('--speculate', dest='speculate', default=False, action='store_true',
+  help='Once all tasks are launched, start a second copy of any task that has '
+       'run much longer than most on another node, and keep whichever finishes '
+       'first. Not required.')
 
 oArgs, pArgs = opts.parse_args()
 if len(pArgs) != 1:
@@ -101,6 +145,34 @@ mem = oArgs.mem # pass mem arg in as is, for Slurm to interpret
 
 walltime = oArgs.walltime
 
+prefetch = max(1, oArgs.prefetch)
+
+agentopt = oArgs.agents and ' --nodeAgents' or ''
+
+if oArgs.transport == 'native':
+    transportopt = ' --transport=native'
+else:
+    transportopt = ' --pnwss'
+
+resumeopt = oArgs.resume and ' --resume' or ''
+
+# the driver stops starting tasks that won't finish within the walltime.
+try:
+    deadlineopt = ' --deadline=$((SQSTART + %d))' % slurmtime(walltime)
+except ValueError:
+    sys.stderr.write('Warning: could not make sense of walltime %s; the run will not stop short of it\n' % (walltime,))
+    deadlineopt = ''
+
+longestopt = oArgs.longestFirst and ' --longestFirst' or ''
+
+speculateopt = oArgs.speculate and ' --speculate' or ''
+
+telemetryopt = oArgs.telemetry > 0 and ' --telemetry=%g' % oArgs.telemetry or ''
+
+statusopt = oArgs.statusPort >= 0 and ' --statusPort=%d' % oArgs.statusPort or ''
+
+retryopt = oArgs.retries > 0 and ' --retries=%d --retryElsewhere' % oArgs.retries or ''
+
 logdir = os.path.abspath(oArgs.logdir)
 
 if os.getenv('SQ_PYTHON'):
@@ -114,8 +186,8 @@ sq_python_path = os.getenv('SQ_PYTHON_PATH', '')
 # specified more workers than makes sense for the number of tasks
 # in the task file.
 
-if os.path.exists(jobFile):
-    ntasks = len([x for x in open(jobFile).readlines() if x.strip() and x.strip()[0] != '#'])
+if os.path.isfile(jobFile):
+    ntasks = sqtaskfile.TaskFile(jobFile).ntasks
     if workers > ntasks:
         sys.stderr.write('Warning: %s contains %d tasks, but you requested '
                          '%d nodes\n' % \
@@ -126,6 +198,9 @@ if os.path.exists(jobFile):
         sys.stderr.write('Info: average tasks per worker: %.1f\n' % tasksperworker)
         if tasksperworker < 1.0:
             sys.stderr.write('Info: you might consider using fewer nodes\n')
+elif os.path.exists(jobFile) or jobFile == '-' or jobFile.startswith('tcp:'):
+    # a named pipe, stdin or a port: tasks are streamed to the driver.
+    sys.stderr.write('Info: tasks will be read from %s as they arrive\n' % (jobFile,))
 else:
     sys.stderr.write('Warning: %s does not currently exist\n' % (jobFile,))
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# args [LogDir | Host:Port]
+import glob, json, optparse, os, sys, time, urllib2
+
+opts = optparse.OptionParser(usage='''%prog OPTIONS [LogDir | Host:Port]
+
+Show how a running SimpleQueue job is getting on: tasks done and left,
+the rate they are finishing at, a projected finish time, where each
+task file is (which DRAIN segment, and whether it is held at one), and
+what each node is running. This asks the driver's status server (see
+--statusPort), whose address the driver writes to status.address in
+its logging directory. Without an argument, the newest SQ_Files_*
+directory in the current directory is used.''')
+
+opts.add_option('-j', '--json', dest='json', default=False, action='store_true',
+  help='Print the status as the driver sends it, in JSON. Not required.')
+opts.add_option('-H', '--hosts', dest='hosts', default=False, action='store_true',
+  help='List every node, not just the totals. Not required.')
+opts.add_option('-w', '--watch', type='float', dest='watch', default=0,
+  help='Show the status again every this many seconds, until interrupted. '
+       'Defaults to %default (once).')
+
+def hms(s):
+    s = int(s)
+    return '%d:%02d:%02d' % (s / 3600, s / 60 % 60, s % 60)
+
+def address(target):
+    # host:port, from the argument or a logging directory's status.address.
+    if not target:
+        dirs = [d for d in glob.glob('SQ_Files_*') if os.path.exists(os.path.join(d, 'status.address'))]
+        if not dirs:
+            raise RuntimeError('no SQ_Files_* directory here has a status.address (was the driver run with --statusPort?); give a LogDir or Host:Port')
+        target = max(dirs, key=lambda d: os.path.getmtime(os.path.join(d, 'status.address')))
+    if os.path.isdir(target):
+        try:
+            host, port = open(os.path.join(target, 'status.address')).read().split()
+        except (IOError, ValueError), e:
+            raise RuntimeError('could not read the status address in %s (was the driver run with --statusPort?): %s' % (target, e))
+        return '%s:%s' % (host, port)
+    return target
+
+def show(st, hosts):
+    now = st['time']
+    c = st['counts']
+    print('%s, running for %s' % (time.strftime('%F %T', time.localtime(now)), hms(now - st['started'])))
+    left = st['remaining'] != None and ' of %d, %d left' % (c['Done'] + st['remaining'], st['remaining']) or ''
+    print('  tasks: %d launched, %d done (%d succeeded, %d failed)%s' % (c['Launched'], c['Done'], c['Succeeded'], c['Failed'], left))
+    print('  rate: %.3f/s over the last %ds, %.3f/s overall' % (st['recentRate'], st['rateWindow'], st['rate']))
+    if st['eta']:
+        print('  projected finish: %s (in %s)' % (time.strftime('%F %T', time.localtime(st['eta'])), hms(max(st['eta'] - now, 0))))
+    elif st['remaining'] == None:
+        print('  projected finish: unknown (tasks are being streamed in)')
+    else:
+        print('  projected finish: unknown (no tasks finished lately)')
+    if st['deadline']:
+        print('  deadline: %s' % time.strftime('%F %T', time.localtime(st['deadline'])))
+    if st['finishing']:
+        print('  the run is finishing up')
+    pool = st['pool']
+    print('  slots: %d busy of %d on %d node(s)%s' % (pool['busy'], pool['slots'], len(pool['hosts']),
+        pool['waitingFor'] and pool['busy'] < pool['slots'] and ', the rest waiting for %s' % pool['waitingFor'] or ''))
+    if pool['shuttingDown']:
+        print('  shutting down')
+    for f in st['files']:
+        where = f['drainingAt'] and 'held at DRAIN (task %s)' % f['drainingAt'] or f['finished'] and 'all read' or 'reading'
+        of = f['tasks'] != None and ' of %d' % f['tasks'] or ''
+        print('  %s: %d done%s, %d running, %d waiting on groups, segment %d, %s' % (f['file'], f['done'], of, f['active'], f['held'], f['segment'], where))
+    if hosts:
+        for h in sorted(pool['hosts']):
+            e = pool['hosts'][h]
+            print('    %s: %d engine(s), %d of %d slot(s) busy, %d task(s)' % (h, e['engines'], e['busy'], e['slots'], e['tasks']))
+
+oArgs, pArgs = opts.parse_args()
+if len(pArgs) > 1:
+    opts.print_help(sys.stderr)
+    sys.exit(1)
+
+try:
+    url = 'http://%s/status' % address(pArgs and pArgs[0] or None)
+except RuntimeError, e:
+    sys.stderr.write('Error: %s\n' % e)
+    sys.exit(1)
+
+while 1:
+    try:
+        body = urllib2.urlopen(url, timeout=10).read()
+    except (urllib2.URLError, IOError), e:
+        sys.stderr.write('Error: could not reach %s (has the run finished?): %s\n' % (url, e))
+        sys.exit(1)
+    if oArgs.json:
+        sys.stdout.write(body)
+    else:
+        show(json.loads(body), oArgs.hosts)
+    if oArgs.watch <= 0: break
+    sys.stdout.flush()
+    time.sleep(oArgs.watch)
+    print('')
@@ -0,0 +1,200 @@
+#
+# Task output. Each slot appends its tasks' output to <outbase>_uc.out
+# and <outbase>_uc.err, and notes where each task's output starts in
+# <outbase>_split (see sqrunner.py). Slots run one task at a time, so a
+# task's output runs from its start to the next task's start in the
+# same files, or to the end of them.
+#
+# The first time a logging directory's output is looked at, the split
+# files are read once and turned into an index, output.IDX, which later
+# opens reuse for as long as the split and output files are unchanged.
+# It has a record for each task index, so any task's output is found by
+# reading a single record, and read straight out of the memory mapped
+# output files. A task that ran more than once (see --retries and
+# --speculate) is indexed by its latest start; the record says how many
+# runs there were.
+#
+# output.IDX is a fixed size header, then one record per task index up
+# to the largest one seen, then the output file names (the parts before
+# _uc.out), one per line. All numbers are little-endian.
+#
+
+import array, glob, logging, mmap, os, struct
+LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
+
+__all__ = ['OutputIndex']
+
+# magic, split files, split bytes, output bytes, latest mtime, records, output files.
+Header = struct.Struct('<8sQQQdQQ8x')
+Magic = 'SQOIDX01'
+# output file (-1: no such task), runs, stdout offset, length, stderr offset, length.
+Record = struct.Struct('<iiqqqq')
+
+def splitFiles(logdir):
+    return sorted(glob.glob(os.path.join(logdir, '*_split')))
+
+def signature(splits):
+    # what the index was built from: changes if any task has started, or
+    # written more output, since.
+    nbytes, obytes, mtime = 0, 0, 0.
+    for f in splits:
+        base = f[:-len('_split')]
+        for name in (f, base + '_uc.out', base + '_uc.err'):
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            if name == f:
+                nbytes += st.st_size
+            else:
+                obytes += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return len(splits), nbytes, obytes, mtime
+
+def parseSplit(fileName):
+    # (index, stderr offset, stdout offset, start time) for each line, in
+    # order. lines from before start times were recorded have none.
+    entries = []
+    for l in open(fileName):
+        head = l.split(':', 1)[0].split()
+        try:
+            if len(head) == 4:
+                entries.append((int(head[0]), int(head[1]), int(head[2]), float(head[3])))
+            elif len(head) == 3:
+                entries.append((int(head[0]), int(head[1]), int(head[2]), None))
+        except ValueError:
+            LogW('Ignoring bad split record in %s: %s'%(fileName, repr(l)))
+    return entries
+
+def fileSize(name):
+    try:
+        return os.path.getsize(name)
+    except OSError:
+        return 0
+
+class OutputIndex:
+    def __init__(self, logdir, save=True):
+        self.logdir = logdir
+        self.idxName = os.path.join(logdir, 'output.IDX')
+        splits = splitFiles(logdir)
+        self.sig = signature(splits)
+        if not self.load(): self.build(splits, save)
+        self.maps = {}
+
+    def load(self):
+        try:
+            idxf = open(self.idxName, 'rb')
+        except IOError:
+            return False
+        try:
+            hdr = idxf.read(Header.size)
+            if len(hdr) != Header.size: return False
+            magic, nsplits, nbytes, obytes, mtime, records, nfiles = Header.unpack(hdr)
+            if magic != Magic or (nsplits, nbytes, obytes, mtime) != self.sig: return False
+            idxf.seek(Header.size + records*Record.size)
+            self.bases = [os.path.join(self.logdir, n) for n in idxf.read().split('\n')[:nfiles]]
+            if len(self.bases) != nfiles: return False
+            self.records = records
+            self.index = mmap.mmap(idxf.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            idxf.close()
+        return True
+
+    def build(self, splits, save):
+        self.bases = [f[:-len('_split')] for f in splits]
+        # one array per field, grown as needed, indexed by task.
+        cols = [array.array('i'), array.array('i')] + [array.array('l') for x in xrange(4)]
+        starts = array.array('d')
+        self.records = 0
+        for k, f in enumerate(splits):
+            entries = parseSplit(f)
+            ends = (fileSize(self.bases[k] + '_uc.err'), fileSize(self.bases[k] + '_uc.out'))
+            for n, (i, errOff, outOff, start) in enumerate(entries):
+                if n + 1 < len(entries):
+                    errEnd, outEnd = entries[n+1][1], entries[n+1][2]
+                else:
+                    errEnd, outEnd = ends
+                if i >= len(cols[0]):
+                    grow = max(i + 1, 2*len(cols[0])) - len(cols[0])
+                    cols[0].extend(array.array('i', [-1])*grow)
+                    for c in cols[1:]: c.extend(array.array(c.typecode, [0])*grow)
+                    starts.extend(array.array('d', [-1.])*grow)
+                cols[1][i] += 1
+                self.records = max(self.records, i + 1)
+                # the latest run wins; without start times, the last one read.
+                if start == None: start = 0.
+                if start < starts[i]: continue
+                starts[i] = start
+                cols[0][i], cols[2][i], cols[3][i], cols[4][i], cols[5][i] = k, outOff, max(outEnd - outOff, 0), errOff, max(errEnd - errOff, 0)
+        self.cols = cols
+        self.index = None
+        if save: self.save()
+
+    def save(self):
+        # written under a temporary name, so a reader never sees a partial index.
+        tmpName = '%s.%d'%(self.idxName, os.getpid())
+        try:
+            idxf = open(tmpName, 'wb')
+            idxf.write(Header.pack(*((Magic,) + self.sig + (self.records, len(self.bases)))))
+            for x in xrange(0, self.records, 65536):
+                idxf.write(''.join([Record.pack(*[c[i] for c in self.cols]) for i in xrange(x, min(x + 65536, self.records))]))
+            idxf.write(''.join([os.path.basename(b) + '\n' for b in self.bases]))
+            idxf.close()
+            os.rename(tmpName, self.idxName)
+        except (IOError, OSError), e:
+            LogW('Could not save output index %s: %s'%(self.idxName, e))
+            try: os.unlink(tmpName)
+            except OSError: pass
+
+    def __len__(self):
+        return self.records
+
+    def record(self, i):
+        # (output file base, runs, stdout offset, length, stderr offset,
+        # length) for task i, or None if it has no output.
+        if i < 0 or i >= self.records: return None
+        if self.index != None:
+            r = Record.unpack_from(self.index, Header.size + i*Record.size)
+        else:
+            r = tuple([c[i] for c in self.cols])
+        if r[0] < 0: return None
+        return (self.bases[r[0]],) + r[1:]
+
+    def data(self, base, suffix):
+        # the memory mapped output file ('' if it is empty or missing).
+        name = base + suffix
+        m = self.maps.get(name)
+        if m == None:
+            m = ''
+            if os.path.exists(name):
+                f = open(name, 'rb')
+                if os.fstat(f.fileno()).st_size: m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                f.close()
+            self.maps[name] = m
+        return m
+
+    def copy(self, i, which, out, blockSize=1<<20):
+        # copy task i's stdout (which 'out') or stderr ('err') to out.
+        # returns False if there is no output recorded for task i.
+        r = self.record(i)
+        if not r: return False
+        base, runs, outOff, outLen, errOff, errLen = r
+        off, n = which == 'out' and (outOff, outLen) or (errOff, errLen)
+        if not n: return True
+        data = self.data(base, '_uc.' + which)
+        end = min(off + n, len(data))
+        while off < end:
+            out.write(data[off:min(off + blockSize, end)])
+            off += blockSize
+        return True
+
+    def tasks(self):
+        # the task indices that have output, in order.
+        for i in xrange(self.records):
+            if self.record(i): yield i
+
+    def close(self):
+        for m in self.maps.values():
+            if m: m.close()
+        self.maps = {}
+        if isinstance(self.index, mmap.mmap): self.index.close()
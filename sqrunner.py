@@ -0,0 +1,49 @@
+#
+# Running a single task, as the wrappers (SQDedWrapper.py) and the
+# driver's own slots (SQDedDriver.py --local) do. A slot's tasks append
+# their output to <outbase>_uc.out and <outbase>_uc.err; before each
+# task starts, a line in <outbase>_split gives its index, where its
+# output starts in each file, its start time and its command. As a
+# slot runs one task at a time, a task's output runs from there to where
+# the next one's starts (see sqoutputs.py).
+#
+
+import errno, logging, os, subprocess, time
+LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
+
+__all__ = ['startTask', 'waitTask']
+
+def startTask(i, cmd, outbase):
+    # start task i: (Popen, start time). it runs in a process group of
+    # its own, so that all of it can be killed at once.
+    errf = open('%s_uc.err'%outbase, 'a')
+    errf.seek(0, 2)
+    outf = open('%s_uc.out'%outbase, 'a')
+    outf.seek(0, 2)
+    startTime = time.time()
+    open('%s_split'%outbase, 'a').write('%d %d %d %f: %s\n'%(i, errf.tell(), outf.tell(), startTime, repr(cmd)))
+    try:
+        p = subprocess.Popen(['/bin/bash', '-c', cmd], stdout=outf, stderr=errf, preexec_fn=os.setpgrp)
+    finally:
+        # the child has its own copies.
+        outf.close()
+        errf.close()
+    return p, startTime
+
+def waitTask(p):
+    # like p.wait(), but also returns the resource usage of the task
+    # (and whatever it waited for): user and system cpu seconds, max rss
+    # (KB), major faults, voluntary and involuntary context switches.
+    while 1:
+        try:
+            pid, sts, ru = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR: continue
+            # reaped elsewhere: no usage to be had.
+            return p.wait(), None
+    if os.WIFSIGNALED(sts):
+        p.returncode = -os.WTERMSIG(sts)
+    else:
+        p.returncode = os.WEXITSTATUS(sts)
+    return p.returncode, (ru.ru_utime, ru.ru_stime, ru.ru_maxrss, ru.ru_majflt, ru.ru_nvcsw, ru.ru_nivcsw)
@@ -0,0 +1,117 @@
+#
+# Task files can run to tens of millions of lines. The first time one
+# is opened, the byte offset of each of its entries (the tasks and
+# #SQ_OP lines, numbered as the driver numbers them) is saved in a
+# sidecar, <TaskFile>.IDX, which later opens reuse for as long as the
+# task file's size and mtime are unchanged. The task file and the
+# sidecar are memory mapped, so counts come straight from the sidecar's
+# header and any entry can be read by its index without a scan.
+#
+# The sidecar is a fixed size header followed by one little-endian 8
+# byte offset per entry.
+#
+
+import array, logging, mmap, os, struct, sys
+LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
+
+__all__ = ['TaskFile']
+
+# magic, task file size, task file mtime, entries, tasks.
+Header = struct.Struct('<8sQdQQ24x')
+Magic = 'SQIDX001'
+Offset = struct.Struct('<Q')
+
+class TaskFile:
+    def __init__(self, fileName, save=True):
+        self.fileName = fileName
+        self.idxName = fileName + '.IDX'
+        self.f = open(fileName, 'rb')
+        st = os.fstat(self.f.fileno())
+        self.size, self.mtime = st.st_size, st.st_mtime
+        # mmap won't take an empty file.
+        self.data = self.size and mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) or ''
+        if not self.load(): self.build(save)
+
+    def load(self):
+        try:
+            idxf = open(self.idxName, 'rb')
+        except IOError:
+            return False
+        try:
+            hdr = idxf.read(Header.size)
+            if len(hdr) != Header.size: return False
+            magic, size, mtime, entries, ntasks = Header.unpack(hdr)
+            if magic != Magic or size != self.size or mtime != self.mtime: return False
+            if os.fstat(idxf.fileno()).st_size != Header.size + entries*Offset.size: return False
+            self.entries, self.ntasks = entries, ntasks
+            self.index = mmap.mmap(idxf.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            idxf.close()
+        self.offset = self.mappedOffset
+        return True
+
+    def build(self, save):
+        offsets = array.array('L')
+        off, ntasks = 0, 0
+        self.f.seek(0)
+        for l in self.f:
+            s = l.strip()
+            if s and (s[0] != '#' or s.startswith('#SQ_OP')):
+                offsets.append(off)
+                if s[0] != '#': ntasks += 1
+            off += len(l)
+        self.entries, self.ntasks = len(offsets), ntasks
+        self.index = offsets
+        self.offset = offsets.__getitem__
+        if save: self.save()
+
+    def save(self):
+        # written under a temporary name, so a reader never sees a partial sidecar.
+        tmpName = '%s.%d'%(self.idxName, os.getpid())
+        try:
+            idxf = open(tmpName, 'wb')
+            idxf.write(Header.pack(Magic, self.size, self.mtime, self.entries, self.ntasks))
+            if self.index.itemsize == Offset.size and sys.byteorder == 'little':
+                self.index.tofile(idxf)
+            else:
+                for x in xrange(0, self.entries, 65536):
+                    idxf.write(''.join([Offset.pack(o) for o in self.index[x:x+65536]]))
+            idxf.close()
+            os.rename(tmpName, self.idxName)
+        except (IOError, OSError), e:
+            LogW('Could not save task file index %s: %s'%(self.idxName, e))
+            try: os.unlink(tmpName)
+            except OSError: pass
+
+    def mappedOffset(self, i):
+        if i < 0 or i >= self.entries: raise IndexError('task index out of range')
+        return Offset.unpack_from(self.index, Header.size + i*Offset.size)[0]
+
+    def __len__(self):
+        return self.entries
+
+    def line(self, i):
+        # entry i, stripped.
+        start = self.offset(i)
+        end = self.data.find('\n', start)
+        if end < 0: end = self.size
+        return self.data[start:end].strip()
+
+    def lines(self, start=0):
+        # (index, entry) from entry start on.
+        for i in xrange(start, self.entries):
+            yield i, self.line(i)
+
+    def copyTail(self, i, out, blockSize=1<<20):
+        # copy the task file as is, from entry i to the end.
+        if i >= self.entries: return
+        off = self.offset(i)
+        while off < self.size:
+            out.write(self.data[off:off+blockSize])
+            off += blockSize
+        if self.data[self.size-1] != '\n': out.write('\n')
+
+    def close(self):
+        if self.data: self.data.close()
+        if isinstance(self.index, mmap.mmap): self.index.close()
+        self.f.close()
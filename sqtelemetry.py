@@ -0,0 +1,74 @@
+#
+# Node telemetry (SQDedDriver.py --telemetry). One wrapper per node
+# samples the node's load, cpu, memory and i/o from /proc every so many
+# seconds and sends the samples to the driver in batches, which writes
+# them to telemetry.tsv in the log directory.
+#
+# A sample is a tuple of floats, in the order of Fields. Rates and cpu
+# percentages are over the time since the previous sample.
+#
+
+import logging, os, struct, time
+LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
+
+__all__ = ['Fields', 'Sampler', 'packSamples', 'unpackSamples', 'formatSample']
+
+Fields = ['time', 'load1', 'user%', 'system%', 'iowait%', 'memTotalMB', 'memAvailMB', 'swapUsedMB', 'majflt/s', 'readKB/s', 'writeKB/s']
+Sample = struct.Struct('!%dd'%len(Fields))
+
+# samples are sent once this many have been taken.
+Batch = int(os.environ.get('SQTelemetryBatch', '12'))
+
+def packSamples(samples):
+    return ''.join([Sample.pack(*s) for s in samples])
+
+def unpackSamples(data):
+    return [Sample.unpack_from(data, off) for off in xrange(0, len(data) - Sample.size + 1, Sample.size)]
+
+def formatSample(host, s):
+    # a line of telemetry.tsv.
+    return '\t'.join(['%.3f'%s[0], host] + ['%.2f'%v for v in s[1:]]) + '\n'
+
+def readFields(fileName):
+    # {first word: rest of the words} for a /proc file.
+    d = {}
+    for l in open(fileName):
+        w = l.split()
+        if w: d[w[0].rstrip(':')] = w[1:]
+    return d
+
+class Sampler:
+    def __init__(self):
+        self.last = None
+        # whole disks only, so partitions are not counted twice.
+        self.disks = set([d for d in os.listdir('/sys/block') if not d.startswith(('loop', 'ram', 'zram'))])
+
+    def counters(self):
+        # cumulative counters: time, cpu jiffies, major faults, sectors read and written.
+        cpu = [float(v) for v in readFields('/proc/stat')['cpu']]
+        majflt = float(readFields('/proc/vmstat').get('pgmajfault', [0])[0])
+        rd, wr = 0., 0.
+        for l in open('/proc/diskstats'):
+            w = l.split()
+            if len(w) >= 10 and w[2] in self.disks:
+                rd += float(w[5])
+                wr += float(w[9])
+        return time.time(), cpu, majflt, rd, wr
+
+    def sample(self):
+        # the next sample, or None for the first call, which only sets a baseline.
+        now = self.counters()
+        last, self.last = self.last, now
+        if not last: return None
+        t, cpu, majflt, rd, wr = now
+        dt = max(t - last[0], 1e-6)
+        dcpu = [a - b for a, b in zip(cpu, last[1])]
+        total = max(sum(dcpu[:8]), 1)
+        # user + nice, system + irq + softirq, iowait.
+        user, system, iowait = dcpu[0] + dcpu[1], dcpu[2] + dcpu[5] + dcpu[6], dcpu[4]
+        mem = readFields('/proc/meminfo')
+        kb = lambda k: float(mem.get(k, [0])[0])
+        load1 = float(open('/proc/loadavg').read().split()[0])
+        return (t, load1, 100*user/total, 100*system/total, 100*iowait/total,
+                kb('MemTotal')/1024, kb('MemAvailable')/1024, (kb('SwapTotal') - kb('SwapFree'))/1024,
+                (majflt - last[2])/dt, (rd - last[3])/2/dt, (wr - last[4])/2/dt)
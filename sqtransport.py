@@ -0,0 +1,325 @@
+#
+# A dependency free alternative to running the driver and its wrappers
+# through a NetWorkSpace server (SQDedDriver.py --transport=native).
+#
+# The driver listens on a TCP port and each wrapper keeps one
+# connection to it. Every message is a 4 byte big-endian length
+# (counting everything after it), a 1 byte message type and a body
+# laid out for that type. Strings in a body are a 4 byte length
+# followed by that many bytes.
+#
+#   REGISTER  wrapper -> driver  key, host, engine, slots (0: not an agent)
+#   REPLY     driver -> wrapper  'OK <slots>', with ' sample' for the node's
+#                                sampler (see --telemetry), or 'GO AWAY'
+#   TASKS     driver -> wrapper  count, then count x (index, command)
+#   BYE       driver -> wrapper  (empty)
+#   DONE      wrapper -> driver  index, status, start, stop, rogue, pid
+#                                and, if the task ran, its resource usage
+#   KILL      driver -> wrapper  index (stop that task, if it has it)
+#   TELEMETRY wrapper -> driver  host, then samples (see sqtelemetry.py)
+#
+# Until a connection has registered with the run's key, anything but
+# REGISTER from it is ignored. A connection that sends something that
+# can't be decoded is dropped, and the tasks outstanding on a wrapper
+# whose connection goes are reported as never started.
+#
+# Nothing here is specific to a cluster: a driver and wrappers on
+# localhost work the same way.
+#
+
+import errno, logging, select, socket, sqtelemetry, struct, threading, time, Queue
+from collections import deque
+LogC, LogD, LogE, LogI, LogW = logging.critical, logging.debug, logging.error, logging.info, logging.warning
+
+__all__ = ['NativeServer', 'NativeClient']
+
+REGISTER, REPLY, TASKS, BYE, DONE, KILL, TELEMETRY = range(1, 8)
+
+Header = struct.Struct('!IB')
+Count = struct.Struct('!I')
+Index = struct.Struct('!q')
+# index, has status, status, start, stop, rogue, pid.
+Done = struct.Struct('!qBiddBi')
+# user and system cpu seconds, max rss (KB), major faults, voluntary and
+# involuntary context switches.
+Usage = struct.Struct('!ddqqqq')
+
+def packStr(s):
+    if isinstance(s, unicode): s = s.encode('utf-8')
+    return Count.pack(len(s)) + s
+
+def unpackStr(body, off):
+    n, = Count.unpack_from(body, off)
+    off += Count.size
+    return body[off:off+n], off+n
+
+def frame(mtype, body=''):
+    return Header.pack(len(body)+1, mtype) + body
+
+def encodeRegister(key, host, engine, slots):
+    return frame(REGISTER, packStr(key) + packStr(host) + packStr(engine) + Count.pack(slots))
+
+def decodeRegister(body):
+    key, off = unpackStr(body, 0)
+    host, off = unpackStr(body, off)
+    engine, off = unpackStr(body, off)
+    slots, = Count.unpack_from(body, off)
+    return key, host, engine, slots
+
+def encodeTasks(tasks):
+    return frame(TASKS, Count.pack(len(tasks)) + ''.join([Index.pack(i) + packStr(task) for i, task in tasks]))
+
+def decodeTasks(body):
+    n, = Count.unpack_from(body, 0)
+    off, tasks = Count.size, []
+    for x in xrange(n):
+        i, = Index.unpack_from(body, off)
+        task, off = unpackStr(body, off + Index.size)
+        tasks.append((i, task))
+    return tasks
+
+def encodeDone(i, status, startTime, stopTime, rogue, pid, usage=None):
+    body = Done.pack(i, status != None, status or 0, startTime, stopTime, rogue and 1 or 0, pid)
+    if usage: body += Usage.pack(*usage)
+    return frame(DONE, body)
+
+def decodeDone(body):
+    i, hasStatus, status, startTime, stopTime, rogue, pid = Done.unpack_from(body)
+    if not hasStatus: status = None
+    usage = None
+    if len(body) >= Done.size + Usage.size: usage = Usage.unpack_from(body, Done.size)
+    return i, status, startTime, stopTime, rogue, pid, usage
+
+class MessageReader:
+    # splits a byte stream into (type, body) messages.
+    def __init__(self):
+        self.chunks, self.size = [], 0
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size < Header.size: return []
+        buf = ''.join(self.chunks)
+        msgs, off = [], 0
+        while len(buf) - off >= Header.size:
+            n, mtype = Header.unpack_from(buf, off)
+            if len(buf) - off < Count.size + n: break
+            msgs.append((mtype, buf[off+Header.size:off+Count.size+n]))
+            off += Count.size + n
+        buf = buf[off:]
+        self.chunks, self.size = [buf], len(buf)
+        return msgs
+
+class Connection:
+    # one end of a connection. sends may come from any thread; receives
+    # from only one.
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sendSem = threading.Lock()
+        self.reader = MessageReader()
+        self.received = deque()
+
+    def send(self, data):
+        self.sendSem.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.sendSem.release()
+
+    def recv(self):
+        while not self.received:
+            data = self.sock.recv(65536)
+            if not data: raise EOFError('connection closed')
+            self.received.extend(self.reader.feed(data))
+        return self.received.popleft()
+
+    def close(self):
+        try: self.sock.close()
+        except: pass
+
+class NativeServer(threading.Thread):
+    # the driver's end. a single thread reads from every connection;
+    # registrations and completions are handed over through queues.
+    # completions come out as the same tuples wrappers store in the
+    # workspace: (index, status, start, stop, rogue, pid, host, engine,
+    # usage).
+    def __init__(self, key, interface='', port=0, name='NativeServer'):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.key = key
+        self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.lsock.bind((interface, port))
+        self.lsock.listen(socket.SOMAXCONN)
+        self.host = socket.gethostname()
+        self.port = self.lsock.getsockname()[1]
+        self.registrations = Queue.Queue(0)
+        self.completions = Queue.Queue(0)
+        self.telemetry = Queue.Queue(0)
+        self.conns = {}  # engine -> Connection
+        self.peers = {}  # fd -> [Connection, host, engine]
+        # tasks sent to each engine and not yet reported on, so that
+        # those of an engine that goes away are not waited for forever.
+        self.outstanding = {}  # engine -> set of indices
+        self.lost = set()  # engines whose connection has gone
+        self.monSem = threading.Lock()       # used to implement monitor-like access to an instance.
+        self.start()
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.lsock.fileno(), select.POLLIN)
+        while 1:
+            try:
+                events = poller.poll()
+            except select.error, e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for fd, ev in events:
+                if fd == self.lsock.fileno():
+                    try:
+                        sock, addr = self.lsock.accept()
+                    except socket.error, e:
+                        # e.g., out of file descriptors: let some close.
+                        LogW('Could not accept a connection: %s'%e)
+                        time.sleep(.1)
+                        continue
+                    self.peers[sock.fileno()] = [Connection(sock), addr[0], None]
+                    poller.register(sock.fileno(), select.POLLIN)
+                    continue
+                # it may have been dropped earlier in this batch.
+                peer = self.peers.get(fd)
+                if not peer: continue
+                try:
+                    data = peer[0].sock.recv(65536)
+                except socket.error, e:
+                    data = ''
+                if not data:
+                    self.drop(poller, fd, 'closed')
+                    continue
+                # one bad peer is dropped; the rest carry on.
+                try:
+                    for mtype, body in peer[0].reader.feed(data):
+                        self.handle(peer, mtype, body)
+                except Exception, e:
+                    LogW('Bad message from %s (engine %s): %s'%(peer[1], peer[2], e))
+                    self.drop(poller, fd, 'dropped')
+
+    def drop(self, poller, fd, why):
+        poller.unregister(fd)
+        peer = self.peers.pop(fd)
+        peer[0].close()
+        LogD('Connection from %s (engine %s) %s.'%(peer[1], peer[2], why))
+        engine = peer[2]
+        if engine == None or self.conns.get(engine) is not peer[0]: return
+        self.monSem.acquire()
+        self.conns.pop(engine)
+        self.lost.add(engine)
+        left = sorted(self.outstanding.pop(engine, ()))
+        self.monSem.release()
+        if left:
+            # it went before reporting on these: count them as never started.
+            LogW('Engine %s (%s) went away with %d task(s) outstanding.'%(engine, peer[1], len(left)))
+            for i in left: self.completions.put((i, None, -1., -1., 0, 0, peer[1], engine, None))
+
+    def handle(self, peer, mtype, body):
+        if mtype == REGISTER:
+            key, host, engine, slots = decodeRegister(body)
+            if key != self.key:
+                LogW('Ignoring registration from %s for another run (%s).'%(host, key))
+                return
+            peer[1], peer[2] = host, engine
+            self.conns[engine] = peer[0]
+            self.registrations.put((host, engine, slots))
+        elif peer[2] == None:
+            # nothing but a registration is taken from an unknown peer.
+            LogW('Ignoring message type %d from %s, which has not registered.'%(mtype, peer[1]))
+        elif mtype == DONE:
+            i, status, startTime, stopTime, rogue, pid, usage = decodeDone(body)
+            self.monSem.acquire()
+            self.outstanding.get(peer[2], set()).discard(i)
+            self.monSem.release()
+            self.completions.put((i, status, startTime, stopTime, rogue, pid, peer[1], peer[2], usage))
+        elif mtype == TELEMETRY:
+            host, off = unpackStr(body, 0)
+            self.telemetry.put((host, sqtelemetry.unpackSamples(body[off:])))
+        else:
+            LogW('Ignoring unexpected message type %d from %s.'%(mtype, peer[1]))
+
+    def register(self):
+        # block until the next wrapper registers: (host, engine, slots).
+        return self.registrations.get(True)
+
+    def reply(self, engine, reply):
+        self.conns[engine].send(frame(REPLY, packStr(reply)))
+
+    def sendTasks(self, engine, tasks):
+        indices = [i for i, task in tasks]
+        self.monSem.acquire()
+        conn = self.conns.get(engine)
+        if conn: self.outstanding.setdefault(engine, set()).update(indices)
+        self.monSem.release()
+        if not conn: raise socket.error('engine %s has gone'%engine)
+        try:
+            conn.send(encodeTasks(tasks))
+        except:
+            # the caller accounts for these.
+            self.monSem.acquire()
+            self.outstanding.get(engine, set()).difference_update(indices)
+            self.monSem.release()
+            raise
+
+    def bye(self, engine):
+        try:
+            self.conns[engine].send(frame(BYE))
+        except (socket.error, KeyError), e:
+            LogI('Could not say goodbye to engine %s: %s'%(engine, e))
+
+    def kill(self, engine, i):
+        try:
+            self.conns[engine].send(frame(KILL, Index.pack(i)))
+        except (socket.error, KeyError), e:
+            LogI('Could not tell engine %s to stop task %d: %s'%(engine, i, e))
+
+    def nextCompletions(self):
+        # block for one completion, then take whatever else is waiting.
+        batch = [self.completions.get(True)]
+        try:
+            while 1: batch.append(self.completions.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def nextTelemetry(self):
+        # block for the next batch of samples: (host, samples).
+        return self.telemetry.get(True)
+
+    def stop(self):
+        try: self.lsock.close()
+        except: pass
+
+class NativeClient:
+    # a wrapper's end.
+    def __init__(self, key, host, port):
+        self.key = key
+        self.conn = Connection(socket.create_connection((host, port)))
+
+    def register(self, host, engine, slots=0):
+        self.conn.send(encodeRegister(self.key, host, engine, slots))
+        mtype, body = self.conn.recv()
+        return unpackStr(body, 0)[0]
+
+    def nextBatch(self):
+        # a list of (index, command), with (-1, 'bye') for a goodbye
+        # and (-2, index) to stop a task.
+        mtype, body = self.conn.recv()
+        if mtype == TASKS: return decodeTasks(body)
+        if mtype == BYE: return [(-1, 'bye')]
+        if mtype == KILL: return [(-2, Index.unpack(body)[0])]
+        raise ValueError('unexpected message type %d'%mtype)
+
+    def sendStatus(self, i, status, startTime, stopTime, rogue, pid, usage=None):
+        self.conn.send(encodeDone(i, status, startTime, stopTime, rogue, pid, usage))
+
+    def sendTelemetry(self, host, samples):
+        self.conn.send(frame(TELEMETRY, packStr(host) + sqtelemetry.packSamples(samples)))